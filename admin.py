@@ -0,0 +1,278 @@
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import select, update, delete, and_, or_
+from sqlalchemy.inspection import inspect
+from database import db, Employee, Department, Product, Transaction, Client, Inventory, TransactionItem, Address, UserCart, CartItem
+from cache import changes
+
+
+# tables reachable from the employees pages
+MODEL_MAPPING = {
+    "employees": Employee,
+    "departments": Department,
+    "products": Product,
+    "transactions": Transaction,
+    "clients": Client,
+    "inventory": Inventory,
+}
+
+PAGE_SIZE = 50
+HIDDEN_COLUMNS = {"password"}  # never leaves the database through the admin pages
+
+Page = namedtuple("Page", ["columns", "rows", "primary_key", "next_after", "next_value", "sortable", "filterable"])
+
+
+def visible_columns(model):
+    """ Returns the table columns of a model that employees are allowed to see. """
+    return [attr.columns[0] for attr in inspect(model).column_attrs if attr.key not in HIDDEN_COLUMNS]
+
+
+def sortable_columns(model):
+    # keyset pagination compares against the last row's sort value, so nullable columns can't be used
+    return {c.name: c for c in visible_columns(model) if c.primary_key or not c.nullable}
+
+
+def filterable_columns(model):
+    return {c.name: c for c in visible_columns(model) if c.type.python_type in (str, int, Decimal)}
+
+
+def filter_clause(column, value):
+    """ Prefix match for text columns and equality for numbers. Raises ValueError on bad input. """
+    python_type = column.type.python_type
+    if python_type is str:
+        return column.startswith(value, autoescape=True)
+    try:
+        return column == python_type(value)
+    except (ValueError, InvalidOperation):
+        raise ValueError(f"invalid value for {column.name}: {value}")
+
+
+def sort_value(column, value):
+    """ Parses the sort value of a page link back into the column's type. Raises ValueError on bad input. """
+    python_type = column.type.python_type
+    try:
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type is bool:
+            return value == "True"
+        return python_type(value)
+    except (ValueError, InvalidOperation):
+        raise ValueError(f"invalid value for {column.name}: {value}")
+
+
+def browse_table(model, after=None, after_value=None, sort=None, descending=False, filter_column=None, filter_value=None,
+                 limit=PAGE_SIZE):
+    """ Reads one page of a table as column tuples, ordered by sort and then by primary key.
+    after and after_value are the primary key and sort value (as text) of the last row of the previous page
+    (keyset pagination), so the cost of a page doesn't depend on how deep into the table it is, and the
+    next page is still right when that row was deleted meanwhile. """
+    columns = visible_columns(model)
+    primary_key = inspect(model).primary_key[0]
+    sortable = sortable_columns(model)
+    filterable = filterable_columns(model)
+    sort_column = sortable.get(sort, primary_key)
+
+    query = select(*columns)
+    if filter_column in filterable and filter_value:
+        query = query.where(filter_clause(filterable[filter_column], filter_value))
+
+    if after is not None:
+        if sort_column is primary_key:
+            query = query.where(primary_key < after if descending else primary_key > after)
+        else:
+            if after_value is None:
+                raise ValueError(f"page link without a {sort_column.name} value")
+            anchor = sort_value(sort_column, after_value)
+            if descending:
+                query = query.where(or_(sort_column < anchor, and_(sort_column == anchor, primary_key < after)))
+            else:
+                query = query.where(or_(sort_column > anchor, and_(sort_column == anchor, primary_key > after)))
+
+    order_by = [sort_column, primary_key] if sort_column is not primary_key else [primary_key]
+    query = query.order_by(*(c.desc() if descending else c for c in order_by))
+
+    # one extra row tells whether there is a next page without counting the table
+    rows = db.session.execute(query.limit(limit + 1)).mappings().all()
+    next_after = next_value = None
+    if len(rows) > limit:
+        next_after = rows[limit - 1][primary_key.name]
+        next_value = str(rows[limit - 1][sort_column.name]) if sort_column is not primary_key else None
+    return Page(
+        columns=[c.name for c in columns],
+        rows=rows[:limit],
+        primary_key=primary_key.name,
+        next_after=next_after,
+        next_value=next_value,
+        sortable=list(sortable),
+        filterable=list(filterable),
+    )
+
+
+# tables that only employees with the given clearance code may read in bulk
+RESTRICTED_TABLES = {"employees": "99"}
+
+# timestamp column used by the incremental "since" export of each table
+SINCE_COLUMNS = {
+    "transactions": Transaction.transaction_date,
+    "inventory": Inventory.last_updated,
+    "clients": Client.created_at,
+    "employees": Employee.created_at,
+}
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def export_rows(table_name, since=None):
+    """ Streams the visible columns of a table as dicts, in primary key order, through a server-side cursor. """
+    model = MODEL_MAPPING[table_name]
+    columns = visible_columns(model)
+    query = select(*columns).order_by(inspect(model).primary_key[0])
+    if since is not None:
+        query = query.where(SINCE_COLUMNS[table_name] > since)
+    result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for row in result.mappings():
+        yield row
+
+
+def as_csv(rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row[c] for c in columns)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def as_ndjson(rows, columns):
+    for row in rows:
+        yield json.dumps({c: row[c] for c in columns}, default=str) + "\n"
+
+
+MAX_BATCH_KEYS = 1000
+BATCH_ACTIONS = ("update", "delete", "void")
+
+# what changes.touch() keys a bulk statement on each table by, for the caches watching that model
+TOUCH_KEYS = {
+    Product: Product.product_id,
+    Inventory: Inventory.product_id,
+    Department: Department.department_id,
+    Client: Client.user_id,
+    Employee: Employee.user_id,
+}
+
+
+def coerce_patch(model, patch):
+    """ Converts a {column: value} patch from JSON to column values. Raises ValueError for unknown,
+    hidden or primary key columns, nulls in required columns and values of the wrong type. """
+    if not isinstance(patch, dict) or not patch:
+        raise ValueError("patch must be a non-empty object of column values")
+    columns = {c.name: c for c in visible_columns(model) if not c.primary_key}
+    values = {}
+    for name, value in patch.items():
+        column = columns.get(name)
+        if column is None:
+            raise ValueError(f"{name} can't be changed in {model.__tablename__}")
+        if value is None:
+            if not column.nullable:
+                raise ValueError(f"{name} can't be empty")
+            values[name] = None
+            continue
+        python_type = column.type.python_type
+        try:
+            if python_type is bool:
+                if not isinstance(value, bool):
+                    raise ValueError
+                values[name] = value
+            elif python_type is datetime:
+                values[name] = datetime.fromisoformat(value)
+            elif python_type is Decimal:
+                values[name] = Decimal(str(value))
+            elif python_type is int:
+                if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                    raise ValueError
+                values[name] = int(value)
+            else:
+                values[name] = python_type(value)
+        except (TypeError, ValueError, InvalidOperation):
+            raise ValueError(f"invalid value for {name}: {value!r}")
+    return values
+
+
+def _delete_dependents(model, keys):
+    """ Bulk deletes skip the ORM cascades, so the rows that a session.delete() of the same records
+    would remove (or detach) are handled here first. """
+    if model is Product:
+        db.session.execute(delete(Inventory).where(Inventory.product_id.in_(keys)))
+        changes.touch(db.session, Inventory, keys)
+    elif model is Department:
+        product_ids = db.session.scalars(select(Product.product_id).where(Product.department_id.in_(keys))).all()
+        db.session.execute(update(Product).where(Product.product_id.in_(product_ids)).values(department_id=None))
+        changes.touch(db.session, Product, product_ids)
+    elif model is Client:
+        cart_ids = select(UserCart.cart_id).where(UserCart.client_id.in_(keys))
+        lines = db.session.execute(select(CartItem.cart_id, CartItem.product_id).where(CartItem.cart_id.in_(cart_ids))).all()
+        db.session.execute(delete(CartItem).where(CartItem.cart_id.in_(cart_ids)))
+        changes.touch(db.session, CartItem, [tuple(line) for line in lines])
+        db.session.execute(delete(UserCart).where(UserCart.client_id.in_(keys)))
+        db.session.execute(delete(Address).where(Address.client_id.in_(keys)))
+    elif model is Employee:
+        db.session.execute(delete(Address).where(Address.employee_id.in_(keys)))
+    elif model is Transaction:
+        db.session.execute(delete(TransactionItem).where(TransactionItem.transaction_id.in_(keys)))
+
+
+def batch_apply(table_name, keys, action, patch=None):
+    """ Applies one action to the rows of table_name with primary keys in keys, with set-based
+    statements in one transaction: "update" sets the patch's columns, "delete" removes the rows (and
+    what the ORM would cascade to) and "void" flags transactions as voided, leaving stock untouched.
+    Returns one {"key", "status"} per requested key, in request order; status is the action done
+    ("updated", "deleted", "voided"), "not_found" or "already_voided". Raises ValueError for bad input. """
+    model = MODEL_MAPPING[table_name]
+    if action not in BATCH_ACTIONS:
+        raise ValueError(f"action must be one of {', '.join(BATCH_ACTIONS)}")
+    if not isinstance(keys, list) or not keys or not all(isinstance(key, int) and not isinstance(key, bool) for key in keys):
+        raise ValueError("keys must be a non-empty list of integer primary keys")
+    if len(keys) > MAX_BATCH_KEYS:
+        raise ValueError(f"at most {MAX_BATCH_KEYS} keys per batch")
+    if action == "void" and not hasattr(model, "is_voided"):
+        raise ValueError(f"{table_name} can't be voided")
+    values = coerce_patch(model, patch) if action == "update" else None
+
+    primary_key = inspect(model).primary_key[0]
+    touch_key = TOUCH_KEYS.get(model, primary_key)
+    wanted = list(dict.fromkeys(keys))
+    columns = [primary_key, touch_key] + ([model.is_voided] if action == "void" else [])
+    found = {row[0]: row for row in db.session.execute(select(*columns).where(primary_key.in_(wanted)))}
+
+    statuses = {key: "not_found" for key in wanted}
+    targets = list(found)
+    if action == "void":
+        targets = [key for key in targets if not found[key][2]]
+        statuses.update({key: "already_voided" for key in found if found[key][2]})
+    try:
+        if targets:
+            if action == "update":
+                db.session.execute(update(model).where(primary_key.in_(targets)).values(**values)
+                                   .execution_options(synchronize_session=False))
+            elif action == "void":
+                db.session.execute(update(model).where(primary_key.in_(targets)).values(is_voided=True)
+                                   .execution_options(synchronize_session=False))
+            else:
+                _delete_dependents(model, targets)
+                db.session.execute(delete(model).where(primary_key.in_(targets)).execution_options(synchronize_session=False))
+            changes.touch(db.session, model, [found[key][1] for key in targets])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    done = {"update": "updated", "delete": "deleted", "void": "voided"}[action]
+    statuses.update({key: done for key in targets})
+    db.session.expire_all()  # instances loaded earlier in this request no longer match the rows
+    return [{"key": key, "status": statuses[key]} for key in keys]
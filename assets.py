@@ -0,0 +1,166 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import zlib
+from flask import request, send_file, g, current_app
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+
+STATIC_MAX_AGE = 31536000  # a year; fingerprinted urls change whenever the file does
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".map", ".json", ".svg", ".txt", ".html", ".xml", ".csv", ".ico"}
+COMPRESSIBLE_TYPES = {"text/html", "text/plain", "text/css", "text/csv", "text/javascript", "application/javascript",
+                      "application/json", "application/x-ndjson", "application/xml", "image/svg+xml"}
+MIN_COMPRESS_BYTES = 500  # smaller bodies don't shrink enough to pay for the encoding
+DYNAMIC_BROTLI_QUALITY = 4  # on the fly; precompressed files use the slowest, smallest setting
+STREAM_FLUSH_BYTES = 16 * 1024  # streamed input collected between flushes; flushing every CSV row compresses poorly
+
+
+def _encodings():
+    return ["br", "gzip"] if brotli else ["gzip"]
+
+
+def _compressor(encoding):
+    """ Returns (compress(chunk) -> bytes, flush() -> bytes, finish() -> bytes). flush() emits everything
+    compressed so far, so the client can use it before the response is complete. """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=DYNAMIC_BROTLI_QUALITY)
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31: gzip container
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def _compress_stream(chunks, encoding):
+    compress, flush, finish = _compressor(encoding)
+    unflushed = 0
+    try:
+        for chunk in chunks:
+            chunk = chunk.encode() if isinstance(chunk, str) else chunk
+            data = compress(chunk)
+            unflushed += len(chunk)
+            if unflushed >= STREAM_FLUSH_BYTES:
+                data += flush()
+                unflushed = 0
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+# Fingerprints every file under static/ by content hash and precompresses the compressible ones.
+# url_for('static', filename=...) gains a ?v=<hash> argument, and requests carrying the current hash
+# are answered with immutable, year-long caching and the precompressed variant the client accepts.
+class StaticAssets:
+    def __init__(self):
+        self.hashes = {}  # filename (relative to static/, "/" separated) -> content hash
+        self.folder = None
+        self.cache_folder = None
+        self._send_static_file = None
+
+    def init_app(self, app):
+        """ Builds the fingerprints, takes over the static endpoint and compresses dynamic responses. """
+        self.folder = app.static_folder
+        self.cache_folder = os.path.join(app.instance_path, "static_cache")
+        self._send_static_file = app.view_functions["static"]
+        self.build()
+        app.url_defaults(self._fingerprint)
+        app.view_functions["static"] = self.serve
+        app.after_request(compress_response)
+
+    def build(self):
+        """ Hashes the static files and writes .gz (and .br) copies of compressible ones that don't
+        have them yet. Returns (files, precompressed). """
+        os.makedirs(self.cache_folder, exist_ok=True)
+        hashes, precompressed = {}, 0
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                if name.startswith((".", "~$")):  # .DS_Store, office lock files
+                    continue
+                path = os.path.join(root, name)
+                with open(path, "rb") as file:
+                    content = file.read()
+                digest = hashlib.sha256(content).hexdigest()[:12]
+                hashes[os.path.relpath(path, self.folder).replace(os.sep, "/")] = digest
+                if os.path.splitext(name)[1].lower() in COMPRESSIBLE_EXTENSIONS:
+                    precompressed += self._precompress(digest, content)
+        self.hashes = hashes
+        return len(hashes), precompressed
+
+    def _precompress(self, digest, content):
+        variants = {"gzip": lambda: gzip.compress(content, 9, mtime=0)}
+        if brotli:
+            variants["br"] = lambda: brotli.compress(content, quality=11)
+        made = 0
+        for encoding, compress in variants.items():
+            path = os.path.join(self.cache_folder, f"{digest}.{encoding}")
+            if not os.path.exists(path):
+                with open(f"{path}.tmp", "wb") as file:
+                    file.write(compress())
+                os.replace(f"{path}.tmp", path)
+                made += 1
+        return made
+
+    def _fingerprint(self, endpoint, values):
+        if endpoint == "static" and "v" not in values:
+            digest = self.hashes.get(values.get("filename"))
+            if digest:
+                values["v"] = digest
+
+    def serve(self, filename):
+        digest = self.hashes.get(filename)
+        if digest is None or request.args.get("v") != digest:
+            # unknown or outdated version: Flask's own, revalidated, static file response
+            return self._send_static_file(filename=filename)
+        encoding = request.accept_encodings.best_match(_encodings())
+        variant = os.path.join(self.cache_folder, f"{digest}.{encoding}") if encoding else None
+        if variant and os.path.exists(variant):
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            response = send_file(variant, mimetype=mimetype, max_age=STATIC_MAX_AGE, etag=f"{digest}-{encoding}")
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response = send_file(os.path.join(self.folder, filename), max_age=STATIC_MAX_AGE, etag=digest)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.vary.add("Accept-Encoding")
+        return response
+
+
+def _breach_exposed(response):
+    # a page holding the csrf token next to text from the request (e.g. the reflected ?q= search) would let
+    # an attacker guess the token from the compressed sizes (BREACH), so such pages go out uncompressed
+    return (response.mimetype == "text/html" and current_app.config.get("WTF_CSRF_FIELD_NAME", "csrf_token") in g
+            and bool(request.args or request.form))
+
+
+def compress_response(response):
+    """ Compresses text responses with brotli or gzip, whichever the client prefers. Streamed
+    bodies (e.g. the table exports) are compressed as they are produced, flushed every STREAM_FLUSH_BYTES. """
+    if (response.status_code < 200 or response.status_code in (204, 206, 304) or response.direct_passthrough
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    if _breach_exposed(response):
+        response.vary.add("Accept-Encoding")
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(_encodings())
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_COMPRESS_BYTES:
+            return response
+        compress, flush, finish = _compressor(encoding)
+        response.set_data(compress(data) + finish())
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+static_assets = StaticAssets()
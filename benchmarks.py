@@ -0,0 +1,57 @@
+import os
+import tempfile
+import click
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import db_profiles
+import passwords
+import search
+
+
+# Load benchmarks, run outside the app: "python benchmarks.py login" or "python benchmarks.py search".
+# They read the same .env settings (PASSWORD_*, SEARCH_*, SQLITE_*) as the store.
+@click.group()
+def benchmarks():
+    load_dotenv()
+
+
+# measures password verifications per second through the worker pool
+@benchmarks.command("login")
+@click.option("--seconds", default=5.0, help="How long to run.")
+@click.option("--concurrency", default=2 * max(passwords.PASSWORD_WORKERS, 1), help="Concurrent sign ins.")
+def bench_login(seconds, concurrency):
+    """ Reports login password checks per second, in total and per worker core. """
+    stored_hash = passwords.password_hasher.hash("benchmark-password")
+    stats = passwords.benchmark(stored_hash, "benchmark-password", seconds, concurrency)
+    print(f"{stats['verifications']} logins in {stats['seconds']}s: {stats['per_sec']}/sec, "
+          f"{stats['per_core']}/sec per core ({passwords.PASSWORD_WORKERS} workers, {concurrency} concurrent, "
+          f"{stats['rejected']} shed, {passwords.PASSWORD_HASH_METHOD})")
+    passwords.password_hasher.shutdown()
+
+
+# times search queries against a synthetic catalog and fails when p95 misses the target
+@benchmarks.command("search")
+@click.option("--products", default=500000, help="Products in the synthetic catalog.")
+@click.option("--queries", default=1000, help="Searches to time.")
+@click.option("--target-ms", default=10.0, help="Highest acceptable p95 latency.")
+@click.option("--path", default=None, help="Where to build the catalog (a temporary file by default).")
+def bench_search(products, queries, target_ms, path):
+    """ Reports search latency percentiles and recall on a synthetic SQLite catalog; exits 1 when p95 exceeds target. """
+    # the catalog file gets the same pragmas as the store's sqlite profile
+    event.listen(Engine, "connect", db_profiles._tune_sqlite)
+    with tempfile.TemporaryDirectory() as folder:
+        stats = search.benchmark(path or os.path.join(folder, "search_bench.db"), products, queries)
+    print(f"{stats['products']} products (built in {stats['build_seconds']}s), {stats['queries']} queries: "
+          f"p50 {stats['p50']}ms, p95 {stats['p95']}ms, p99 {stats['p99']}ms, max {stats['max']}ms")
+    print(f"bm25() in SQL {stats['exact_share']:.0%}, every match of the two rarest phrases {stats['matches_share']:.0%}, "
+          f"best products per term {stats['weights_share'] + stats['deeper_share']:.0%}")
+    if stats["recall"] is not None:
+        print(f"recall {stats['recall']:.0%}: the share of bm25()'s top results that the others found")
+    if stats["p95"] > target_ms:
+        print(f"p95 is above the {target_ms}ms target")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    benchmarks()
@@ -0,0 +1,78 @@
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+
+
+# Collects the rows of watched models touched by a flush and publishes them only after the
+# surrounding transaction commits, so in-memory caches never see rolled back changes.
+class ChangeTracker:
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, models, callback, key=None, before_commit=False):
+        """ Calls callback(keys) after every commit that inserted, updated or deleted a row of models.
+        key(obj) is evaluated at flush time, while the instance attributes are still loaded.
+        With before_commit, callback(session, keys) runs instead just before the commit, inside the
+        committing transaction, so it can write rows that commit (or roll back) with the change. """
+        self._subscribers.append((tuple(models), callback, key or (lambda obj: None), before_commit))
+
+    def touch(self, session, model, keys):
+        """ Records changes made with bulk statements, which bypass the ORM unit of work. """
+        pending = session.info.setdefault("tracked_changes", {})
+        for index, (models, callback, key, before_commit) in enumerate(self._subscribers):
+            if issubclass(model, models):
+                pending.setdefault(index, set()).update(keys)
+
+    def deliver(self, model, keys):
+        """ Publishes changes committed by another process (see catalog.CatalogSync) to the subscribers of model. """
+        for models, callback, key, before_commit in self._subscribers:
+            if issubclass(model, models) and not before_commit:
+                callback(set(keys))
+
+    def collect(self, session):
+        touched = session.new | session.dirty | session.deleted
+        if not touched:
+            return
+        pending = session.info.setdefault("tracked_changes", {})
+        for index, (models, callback, key, before_commit) in enumerate(self._subscribers):
+            keys = {key(obj) for obj in touched if isinstance(obj, models)}
+            if keys:
+                pending.setdefault(index, set()).update(keys)
+
+    def record(self, session):
+        if not any(subscriber[3] for subscriber in self._subscribers):
+            return
+        session.flush()  # collect what is still pending in the unit of work
+        pending = session.info.get("tracked_changes") or {}
+        for index in [index for index in pending if self._subscribers[index][3]]:
+            self._subscribers[index][1](session, pending.pop(index))
+
+    def publish(self, session):
+        pending = session.info.pop("tracked_changes", None)
+        for index, keys in (pending or {}).items():
+            self._subscribers[index][1](keys)
+
+    def discard(self, session):
+        session.info.pop("tracked_changes", None)
+
+
+changes = ChangeTracker()
+
+
+@listens_for(Session, "after_flush")
+def _collect_changes(session, flush_context):
+    changes.collect(session)
+
+
+@listens_for(Session, "before_commit")
+def _record_changes(session):
+    changes.record(session)
+
+
+@listens_for(Session, "after_commit")
+def _publish_changes(session):
+    changes.publish(session)
+
+
+@listens_for(Session, "after_rollback")
+def _discard_changes(session):
+    changes.discard(session)
@@ -0,0 +1,318 @@
+import atexit
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from sqlalchemy import select, insert, update, bindparam, tuple_
+from sqlalchemy.orm import selectinload
+from database import db, UserCart, CartItem, Client, Product
+from cache import changes
+
+
+CART_CACHE_SIZE = int(os.environ.get("CART_CACHE_SIZE", 10000))  # carts kept in memory per process
+CART_FLUSH_SECONDS = float(os.environ.get("CART_FLUSH_SECONDS", 5))  # how long cart changes may stay unsaved
+FLUSH_ATTEMPTS = 3  # writes retried after rebasing carts that another process changed meanwhile
+
+CartLine = namedtuple("CartLine", ["product_id", "quantity", "price", "description"])
+
+
+def _user_cart(user_id):
+    # carts belong to clients, so resolve them through the logged in user's client profile
+    return select(UserCart).join(Client, Client.client_id == UserCart.client_id).where(Client.user_id == user_id)
+
+
+def load_cart(user_id):
+    """ Loads a user's cart together with its items and their products in two queries:
+    one for the cart and one for the items joined to their products. Returns None for non-clients. """
+    return db.session.execute(
+        _user_cart(user_id).options(selectinload(UserCart.cart_items).joinedload(CartItem.product))
+    ).scalar_one_or_none()
+
+
+# In-memory copy of one cart. persisted holds the product ids that have a cart_items row,
+# changed the lines whose row must be inserted, updated or deleted on the next flush, and
+# version the user_carts.version the copy was read or last written at.
+class CachedCart:
+    def __init__(self, user_id, cart_id, client_id, lines, version=0):
+        self.user_id = user_id
+        self.cart_id = cart_id
+        self.client_id = client_id
+        self.version = version
+        self.lines = OrderedDict((line.product_id, line) for line in lines)
+        self.persisted = set(self.lines)
+        self.changed = set()
+
+    @property
+    def cart_items(self):
+        return list(self.lines.values())
+
+    @property
+    def dirty(self):
+        return bool(self.changed)
+
+
+# Bounded, least recently used store of CachedCarts keyed by cart_id. Any object with the same
+# get/put/pop/items methods can replace it (e.g. one backed by a shared cache server, which a
+# multi-worker deployment needs so every worker sees the same carts).
+class LRUCartStore:
+    def __init__(self, max_size=CART_CACHE_SIZE):
+        self.max_size = max_size
+        self._carts = OrderedDict()
+
+    def get(self, cart_id):
+        cart = self._carts.get(cart_id)
+        if cart is not None:
+            self._carts.move_to_end(cart_id)
+        return cart
+
+    def put(self, cart):
+        """ Stores a cart and returns the carts evicted to make room. """
+        self._carts[cart.cart_id] = cart
+        self._carts.move_to_end(cart.cart_id)
+        evicted = []
+        while len(self._carts) > self.max_size:
+            evicted.append(self._carts.popitem(last=False)[1])
+        return evicted
+
+    def pop(self, cart_id):
+        return self._carts.pop(cart_id, None)
+
+    def items(self):
+        return list(self._carts.values())
+
+
+# Serves carts from memory and writes them behind: changes are coalesced per cart line and saved
+# in batches by a background flusher, at shutdown and, synchronously, before checkout.
+# Every write bumps user_carts.version and only goes through if the version is still the one this
+# process read, so two worker processes serving the same user can't overwrite each other's lines:
+# the loser rebases its unsaved lines on the stored cart and writes again.
+class CartService:
+    def __init__(self, store=None):
+        self.store = store or LRUCartStore()
+        self.app = None
+        self._cart_ids = {}  # user_id -> cart_id of the carts in the store or in _evicted
+        self._evicted = {}  # dirty carts pushed out of the store, kept until they are saved
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()  # one writer at a time, without blocking the request threads
+        self._flusher = None
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        """ Lets the background flusher open app contexts, and saves whatever is pending at shutdown. """
+        self.app = app
+
+        def flush_at_exit():
+            with app.app_context():
+                self.flush()
+        atexit.register(flush_at_exit)
+
+    def get(self, user_id):
+        """ Returns the user's CachedCart, loading it on first use, or None for non-clients. """
+        with self._lock:
+            cart = self._cached(self._cart_ids.get(user_id))
+            if cart is not None:
+                self.hits += 1
+                return cart
+        self.misses += 1
+        user_cart = load_cart(user_id)
+        if user_cart is None:
+            return None
+        with self._lock:
+            # another request may have loaded (and changed) the same cart meanwhile
+            cart = self._cached(user_cart.cart_id)
+            if cart is None:
+                cart = CachedCart(user_id, user_cart.cart_id, user_cart.client_id, [
+                    CartLine(item.product_id, item.quantity, item.price, item.product.description)
+                    for item in user_cart.cart_items
+                ], user_cart.version)
+                self._put(cart)
+            self._cart_ids[user_id] = cart.cart_id
+            return cart
+
+    def _cached(self, cart_id):
+        if cart_id is None:
+            return None
+        cart = self.store.get(cart_id)
+        if cart is None and cart_id in self._evicted:
+            cart = self._evicted.pop(cart_id)
+            self._put(cart)
+        return cart
+
+    def _put(self, cart):
+        for evicted in self.store.put(cart):
+            if evicted.dirty:
+                self._evicted[evicted.cart_id] = evicted
+            else:
+                self._cart_ids.pop(evicted.user_id, None)
+
+    def forget(self, cart_id):
+        """ Drops a cart from memory, unsaved changes included. """
+        with self._lock:
+            cart = self.store.pop(cart_id) or self._evicted.pop(cart_id, None)
+            if cart is not None:
+                self._cart_ids.pop(cart.user_id, None)
+
+    def add(self, cart, product_id, quantity, price, description):
+        with self._lock:
+            line = cart.lines.get(product_id)
+            if line:
+                cart.lines[product_id] = line._replace(quantity=line.quantity + quantity)
+            else:
+                cart.lines[product_id] = CartLine(product_id, quantity, price, description)
+            cart.changed.add(product_id)
+        self._start_flusher()
+
+    def remove(self, cart, product_id):
+        with self._lock:
+            if cart.lines.pop(product_id, None) is not None:
+                cart.changed.add(product_id)
+        self._start_flusher()
+
+    def forget_lines(self, keys):
+        """ Drops (cart_id, product_id) lines that were deleted in the database, e.g. paid by checkout. """
+        with self._lock:
+            for cart_id, product_id in keys:
+                cart = self.store.get(cart_id) or self._evicted.get(cart_id)
+                if cart is not None:
+                    cart.lines.pop(product_id, None)
+                    cart.persisted.discard(product_id)
+                    cart.changed.discard(product_id)
+
+    def flush(self, carts=None):
+        """ Saves the pending changes of carts (default: every dirty cart) with one executemany per
+        statement kind, in a single commit. Carts passed in are checked against the stored version even
+        when clean, so checkout always sees what the other workers saved. Must run inside an app context.
+        Returns the number of carts saved. """
+        with self._flush_lock:
+            with self._lock:
+                if carts is None:
+                    carts = [cart for cart in self.store.items() + list(self._evicted.values()) if cart.dirty]
+            saved = 0
+            for attempt in range(FLUSH_ATTEMPTS):
+                if not carts:
+                    break
+                carts, written = self._write(carts)
+                saved += written
+                if carts:
+                    self._rebase(carts)
+            return saved
+
+    def _write(self, carts):
+        """ Writes one batch outside the lock, from a snapshot taken under it. Returns the carts another
+        process wrote since we read them, which were left untouched, and the number of carts written. """
+        with self._lock:
+            snapshot = []
+            for cart in carts:
+                snapshot.append((cart, cart.version, {product_id: cart.lines.get(product_id) for product_id in cart.changed}))
+                cart.changed = set()
+
+        table = CartItem.__table__
+        match = (table.c.cart_id == bindparam("b_cart_id")) & (table.c.product_id == bindparam("b_product_id"))
+        try:
+            # claim every cart whose stored version is still ours; the others changed behind our back
+            claimed = set(db.session.scalars(
+                update(UserCart)
+                .where(UserCart.cart_id.in_([cart.cart_id for cart, version, lines in snapshot]),  # keeps the primary key search
+                       tuple_(UserCart.cart_id, UserCart.version).in_([(cart.cart_id, version) for cart, version, lines in snapshot]))
+                .values(version=UserCart.version + 1)
+                .returning(UserCart.cart_id)
+                .execution_options(synchronize_session=False)
+            ))
+            inserts, updates, deletes = [], [], []
+            for cart, version, lines in snapshot:
+                if cart.cart_id not in claimed:
+                    continue
+                for product_id, line in lines.items():
+                    params = {"b_cart_id": cart.cart_id, "b_product_id": product_id}
+                    if line is None:
+                        if product_id in cart.persisted:
+                            deletes.append(params)
+                    elif product_id in cart.persisted:
+                        updates.append(dict(params, b_quantity=line.quantity))
+                    else:
+                        inserts.append({"cart_id": cart.cart_id, "product_id": product_id, "quantity": line.quantity, "price": line.price})
+            connection = db.session.connection()
+            if deletes:
+                connection.execute(table.delete().where(match), deletes)
+            if updates:
+                connection.execute(table.update().where(match).values(quantity=bindparam("b_quantity")), updates)
+            if inserts:
+                connection.execute(insert(table), inserts)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for cart, version, lines in snapshot:
+                    cart.changed.update(lines)
+            raise
+
+        conflicted = []
+        with self._lock:
+            for cart, version, lines in snapshot:
+                if cart.cart_id not in claimed:
+                    cart.changed.update(lines)
+                    conflicted.append(cart)
+                    continue
+                cart.version = version + 1
+                for product_id, line in lines.items():
+                    if line is None:
+                        cart.persisted.discard(product_id)
+                    else:
+                        cart.persisted.add(product_id)
+                if not cart.dirty and self._evicted.pop(cart.cart_id, None) is not None:
+                    self._cart_ids.pop(cart.user_id, None)
+        return conflicted, len(claimed)
+
+    def _rebase(self, carts):
+        """ Reloads carts that another process wrote: stored lines come back, and the unsaved
+        lines of this process are put on top of them for the next write. """
+        cart_ids = [cart.cart_id for cart in carts]
+        versions = dict(db.session.execute(select(UserCart.cart_id, UserCart.version).where(UserCart.cart_id.in_(cart_ids))).all())
+        stored = {}
+        for row in db.session.execute(
+            select(CartItem.cart_id, CartItem.product_id, CartItem.quantity, CartItem.price, Product.description)
+            .join(Product, Product.product_id == CartItem.product_id)
+            .where(CartItem.cart_id.in_(cart_ids))
+            .order_by(CartItem.c_item_id)
+        ):
+            stored.setdefault(row.cart_id, OrderedDict())[row.product_id] = CartLine(row.product_id, row.quantity, row.price, row.description)
+        db.session.commit()
+        with self._lock:
+            for cart in list(carts):
+                if cart.cart_id not in versions:  # the cart itself is gone
+                    self.forget(cart.cart_id)
+                    carts.remove(cart)
+                    continue
+                lines = stored.get(cart.cart_id, OrderedDict())
+                persisted = set(lines)
+                for product_id in cart.changed:
+                    if product_id in cart.lines:
+                        lines[product_id] = cart.lines[product_id]
+                    else:
+                        lines.pop(product_id, None)
+                cart.lines, cart.persisted, cart.version = lines, persisted, versions[cart.cart_id]
+
+    def _start_flusher(self):
+        if self._flusher is not None or self.app is None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_forever, name="cart-flusher", daemon=True)
+                self._flusher.start()
+
+    def _flush_forever(self):
+        wait = threading.Event()
+        while True:
+            wait.wait(CART_FLUSH_SECONDS)
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                self.app.logger.exception("cart flush failed, retrying on the next round")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+cart_service = CartService()
+changes.subscribe([CartItem], cart_service.forget_lines, key=lambda obj: (obj.cart_id, obj.product_id))
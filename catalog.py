@@ -0,0 +1,298 @@
+import os
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Lock
+from sqlalchemy import select, insert, delete, func
+from database import db, Department, Product, Inventory, CatalogChange
+from cache import changes
+
+
+CATALOG_SYNC_SECONDS = float(os.environ.get("CATALOG_SYNC_SECONDS", 1))  # how stale another worker's change may look here
+CATALOG_CHANGES_KEEP = timedelta(hours=1)  # a worker idle for longer than this rebuilds its caches instead
+SYNC_BATCH = 5000  # more new changes than this are cheaper to handle with a rebuild
+SYNC_OVERLAP = 100  # changes re-read each poll, for sequence numbers that commit out of order on server databases
+
+
+DepartmentEntry = namedtuple("DepartmentEntry", ["department_id", "name"])
+
+
+# Process-local copy of the departments table. It is loaded on first use, served from memory
+# to every template and dropped whenever a Department row is committed.
+class DepartmentRegistry:
+    def __init__(self):
+        self._departments = None
+        self._generation = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def all(self):
+        """ Returns the departments as (department_id, name) tuples ordered by id. """
+        departments = self._departments
+        if departments is not None:
+            self.hits += 1
+            return departments
+        with self._lock:
+            if self._departments is not None:
+                self.hits += 1
+                return self._departments
+            self.misses += 1
+            generation = self._generation
+            rows = db.session.execute(
+                select(Department.department_id, Department.name).order_by(Department.department_id)
+            ).all()
+            departments = [DepartmentEntry(*row) for row in rows]
+            # a commit that landed while we were reading leaves the registry empty for the next caller
+            if generation == self._generation:
+                self._departments = departments
+            return departments
+
+    def get_by_name(self, name):
+        """ Case-insensitive lookup used by the department routes. """
+        name = name.lower()
+        return next((d for d in self.all() if d.name.lower() == name), None)
+
+    def invalidate(self, keys=None):
+        self._generation += 1
+        self._departments = None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+departments = DepartmentRegistry()
+changes.subscribe([Department], departments.invalidate)
+
+
+ProductCard = namedtuple("ProductCard", ["product_id", "department_id", "description", "brand", "price", "image_url", "quantity"])
+
+
+# Per-department read model of the in-stock catalog. It is built once and then patched
+# product by product: commits touching Product or Inventory rows only mark those product ids
+# stale, and the next read refreshes just them with a single query.
+class CatalogReadModel:
+    def __init__(self):
+        self._by_department = None  # department_id -> {product_id: ProductCard}
+        self._sorted = {}  # department_id -> cards ordered by product_id
+        self._stale = set()
+        self._lock = Lock()
+
+    @staticmethod
+    def _in_stock_query():
+        return (
+            select(Product.product_id, Product.department_id, Product.description, Product.brand,
+                   Product.price, Product.image_url, Inventory.quantity)
+            .join(Inventory, Inventory.product_id == Product.product_id)
+            .where(Inventory.quantity > 0)
+        )
+
+    def _build(self):
+        self._stale = set()
+        self._sorted = {}
+        self._by_department = {}
+        for row in db.session.execute(self._in_stock_query()):
+            card = ProductCard(*row)
+            self._by_department.setdefault(card.department_id, {})[card.product_id] = card
+
+    def _refresh(self):
+        stale, self._stale = self._stale, set()
+        for department_id, cards in self._by_department.items():
+            for product_id in stale & cards.keys():
+                del cards[product_id]
+                self._sorted.pop(department_id, None)
+        rows = db.session.execute(self._in_stock_query().where(Product.product_id.in_(stale)))
+        for row in rows:
+            card = ProductCard(*row)
+            self._by_department.setdefault(card.department_id, {})[card.product_id] = card
+            self._sorted.pop(card.department_id, None)
+
+    def _sync(self):
+        if self._by_department is None:
+            self._build()
+        elif self._stale:
+            self._refresh()
+
+    def products(self, department_id):
+        """ Returns the in-stock ProductCards of a department ordered by product id. """
+        with self._lock:
+            self._sync()
+            cards = self._sorted.get(department_id)
+            if cards is None:
+                cards = sorted(self._by_department.get(department_id, {}).values())
+                self._sorted[department_id] = cards
+            return cards
+
+    def get(self, product_id):
+        """ Returns the ProductCard of an in-stock product, or None when it is out of stock or unknown. """
+        with self._lock:
+            self._sync()
+            for cards in self._by_department.values():
+                if product_id in cards:
+                    return cards[product_id]
+        return None
+
+    def mark_stale(self, product_ids):
+        with self._lock:
+            self._stale.update(product_ids)
+
+    def invalidate(self, keys=None):
+        with self._lock:
+            self._by_department = None
+
+    def verify(self):
+        """ Compares the read model with a fresh query and returns the product ids that differ. """
+        with self._lock:
+            self._sync()
+            cached = {product_id: card for cards in self._by_department.values() for product_id, card in cards.items()}
+        fresh = {row.product_id: ProductCard(*row) for row in db.session.execute(self._in_stock_query())}
+        return sorted(product_id for product_id in fresh.keys() | cached.keys()
+                      if fresh.get(product_id) != cached.get(product_id))
+
+in_stock = CatalogReadModel()
+changes.subscribe([Product, Inventory], in_stock.mark_stale, key=lambda obj: obj.product_id)
+
+
+# Version of everything the catalog pages are rendered from, the same in every worker process that
+# caught up with the same changes: the sequence number of the newest catalog_changes row this process
+# has applied (see CatalogSync) and max(Inventory.last_updated), for stock written around the ORM.
+# They are read again after every Product, Inventory or Department change this process commits or
+# receives, never per request.
+class CatalogVersion:
+    def __init__(self):
+        self.counter = 0
+        self._state = None  # (etag, last_modified) at counter
+        self._lock = Lock()
+
+    def bump(self, keys=None):
+        with self._lock:
+            self.counter += 1
+            self._state = None
+
+    def etag(self):
+        return self._current()[0]
+
+    def last_modified(self):
+        """ The newest of max(Inventory.last_updated) and the time of the newest catalog change applied. """
+        return self._current()[1]
+
+    def _current(self):
+        state = self._state
+        if state is None:
+            counter = self.counter
+            sync.poll(force=True)  # numbers this process's own commits too; may bump, then the state isn't kept
+            seq = sync.last_seq
+            changed_at = db.session.scalar(select(CatalogChange.changed_at).where(CatalogChange.seq == seq))
+            newest_stock = db.session.scalar(select(func.max(Inventory.last_updated)))
+            stamp = newest_stock.strftime("%Y%m%d%H%M%S%f") if newest_stock else "0"
+            last_modified = max(filter(None, [newest_stock, changed_at]), default=datetime(2000, 1, 1))
+            state = (f"{seq}-{stamp}", last_modified.replace(tzinfo=None, microsecond=0))
+            with self._lock:
+                if counter == self.counter:  # keep it only if no change landed meanwhile
+                    self._state = state
+        return state
+
+
+version = CatalogVersion()
+changes.subscribe([Product, Inventory, Department], version.bump)
+
+
+# Shares catalog changes between worker processes. Every commit touching Product, Inventory or Department
+# rows also writes them to catalog_changes; each process polls that table at most every CATALOG_SYNC_SECONDS
+# (one indexed range query) and hands the changes made by the other processes to its own cache subscribers.
+class CatalogSync:
+    MODELS = {"products": Product, "inventory": Inventory, "departments": Department}
+
+    def __init__(self, origin):
+        self.origin = origin
+        self._last_seq = None
+        self._seen = set()  # sequence numbers of the overlap window already delivered
+        self._polled_at = 0.0
+        self._synced_at = None
+        self._pruned_at = None
+        self._lock = Lock()
+
+    def record(self, model, session, keys):
+        if len(keys) > SYNC_BATCH:
+            keys = [None]  # a bulk change: the other processes rebuild rather than patch
+        session.execute(insert(CatalogChange), [
+            {"origin": self.origin, "model": model, "key": key, "changed_at": datetime.utcnow()} for key in keys
+        ])
+
+    def poll(self, force=False):
+        """ Applies the catalog changes committed by other processes since the last poll. Runs before
+        every request and returns at once unless CATALOG_SYNC_SECONDS passed (or force is set). """
+        if not force and time.monotonic() - self._polled_at < CATALOG_SYNC_SECONDS:
+            return
+        if not self._lock.acquire(blocking=force):
+            return  # another thread of this process is polling right now
+        try:
+            self._polled_at = time.monotonic()
+            now = datetime.utcnow()
+            if self._last_seq is None or now - self._synced_at > CATALOG_CHANGES_KEEP:
+                # first poll, or the changes we missed may already be pruned: start over from the newest change
+                if self._last_seq is not None:
+                    self._rebuild()
+                self._start_at(db.session.scalar(select(func.max(CatalogChange.seq))) or 0)
+            else:
+                self._apply(db.session.execute(
+                    select(CatalogChange.seq, CatalogChange.origin, CatalogChange.model, CatalogChange.key)
+                    .where(CatalogChange.seq > self._last_seq - SYNC_OVERLAP)
+                    .order_by(CatalogChange.seq)
+                    .limit(SYNC_OVERLAP + SYNC_BATCH)
+                ).all())
+            self._synced_at = now
+            if self._pruned_at is None or now - self._pruned_at > CATALOG_CHANGES_KEEP / 4:
+                self._pruned_at = now
+                with db.engine.begin() as connection:
+                    # the newest change stays, so sequence numbers (and the catalog ETags) never start over
+                    connection.execute(delete(CatalogChange).where(
+                        CatalogChange.changed_at < now - CATALOG_CHANGES_KEEP,
+                        CatalogChange.seq < select(func.max(CatalogChange.seq)).scalar_subquery(),
+                    ))
+        finally:
+            self._lock.release()
+
+    @property
+    def last_seq(self):
+        """ The newest catalog_changes sequence number applied here (0 before the first poll). """
+        return self._last_seq or 0
+
+    def _apply(self, rows):
+        if len(rows) >= SYNC_OVERLAP + SYNC_BATCH:
+            self._rebuild()
+            self._start_at(rows[-1].seq)
+            return
+        keys = {}
+        for row in rows:
+            if row.seq in self._seen:
+                continue
+            self._seen.add(row.seq)
+            self._last_seq = max(self._last_seq, row.seq)
+            if row.origin != self.origin:
+                keys.setdefault(row.model, set()).add(row.key)
+        self._seen = {seq for seq in self._seen if seq > self._last_seq - SYNC_OVERLAP}
+        if None in keys.get("products", ()) or None in keys.get("inventory", ()):
+            self._rebuild()
+            return
+        for model, model_keys in keys.items():
+            changes.deliver(self.MODELS[model], model_keys)
+
+    def _start_at(self, seq):
+        self._last_seq = seq
+        self._seen = set(range(seq - SYNC_OVERLAP + 1, seq + 1))
+
+    def _rebuild(self):
+        in_stock.invalidate()
+        changes.deliver(Department, set())
+        changes.deliver(Product, set())
+
+
+sync = CatalogSync(uuid.uuid4().hex[:8])
+changes.subscribe([Product], lambda session, keys: sync.record("products", session, keys),
+                  key=lambda obj: obj.product_id, before_commit=True)
+changes.subscribe([Inventory], lambda session, keys: sync.record("inventory", session, keys),
+                  key=lambda obj: obj.product_id, before_commit=True)
+changes.subscribe([Department], lambda session, keys: sync.record("departments", session, keys),
+                  key=lambda obj: obj.department_id, before_commit=True)
@@ -1,7 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin, current_user
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Integer, String, Numeric, Text, DateTime, Boolean, select
+from sqlalchemy import Integer, String, Numeric, Text, DateTime, Boolean, select, func
 from datetime import datetime
 import pytz
 
@@ -13,6 +13,12 @@ db = SQLAlchemy(model_class=Base)
 # Products Table
 class Product(db.Model):
     __tablename__ = 'products'
+    __table_args__ = (
+        # department page filters and price sorts
+        db.Index('ix_products_department_id_brand', 'department_id', 'brand'),
+        db.Index('ix_products_department_id_product_family', 'department_id', 'product_family'),
+        db.Index('ix_products_department_id_price', 'department_id', 'price'),
+    )
     product_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     department_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("departments.department_id"), nullable=True)
     description: Mapped[str] = mapped_column(Text, nullable=False)
@@ -28,6 +34,9 @@ class Product(db.Model):
     department = relationship('Department', back_populates='products')
     inventory = relationship('Inventory', back_populates='product', uselist=False, cascade="all, delete-orphan")
 
+# case-insensitive prefix lookups of the admin form autocomplete
+db.Index('ix_products_description_lower', func.lower(Product.description))
+
 # Departments Table
 class Department(db.Model):
     __tablename__ = 'departments'
@@ -40,6 +49,10 @@ class Department(db.Model):
 # Inventory Table
 class Inventory(db.Model):
     __tablename__ = 'inventory'
+    __table_args__ = (
+        db.Index('ix_inventory_product_id_quantity', 'product_id', 'quantity'),  # stock lookups and reservations by product
+        db.Index('ix_inventory_quantity', 'quantity'),  # in-stock catalog (quantity > 0)
+    )
     inventory_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     product_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('products.product_id'), nullable=False)
     quantity: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
@@ -60,7 +73,7 @@ class BaseUser(db.Model, UserMixin):
     __tablename__ = 'users'
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     email: Mapped[str] = mapped_column(String(50), unique=True, nullable=False)
-    password: Mapped[str] = mapped_column(String(100), nullable=False)
+    password: Mapped[str] = mapped_column(String(255), nullable=False)
     
     client = relationship('Client', back_populates='user', uselist=False, cascade="all, delete-orphan")
     employee = relationship('Employee', back_populates='user', uselist=False, cascade="all, delete-orphan")
@@ -68,6 +81,7 @@ class BaseUser(db.Model, UserMixin):
 # Clients Table
 class Client(db.Model):
     __tablename__ = 'clients'
+    __table_args__ = (db.Index('ix_clients_user_id', 'user_id'),)
     client_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('users.id'))
     first_name: Mapped[str] = mapped_column(String(20), nullable=False)
@@ -79,9 +93,14 @@ class Client(db.Model):
     addresses = relationship('Address', back_populates='client', cascade="all, delete-orphan")
     cart = relationship('UserCart', back_populates='client', cascade="all, delete-orphan")
 
+# case-insensitive prefix lookups of the admin form autocomplete
+db.Index('ix_clients_first_name_lower', func.lower(Client.first_name))
+db.Index('ix_clients_last_name_lower', func.lower(Client.last_name))
+
 # Employees Table
 class Employee(db.Model):
     __tablename__ = 'employees'
+    __table_args__ = (db.Index('ix_employees_user_id', 'user_id'),)
     employee_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('users.id'))
     first_name: Mapped[str] = mapped_column(String(20), nullable=False)
@@ -114,6 +133,7 @@ class Address(db.Model):
 # Transactions Table
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    __table_args__ = (db.Index('ix_transactions_client_id_transaction_date', 'client_id', 'transaction_date'),)
     transaction_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     client_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('clients.client_id'), nullable=True)
     store_account_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('store_accounts.st_acc_id'), nullable=True) 
@@ -121,6 +141,7 @@ class Transaction(db.Model):
     total_amount: Mapped[Numeric] = mapped_column(Numeric(10, 2), nullable=False)
     transaction_date: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow())
     is_voided: Mapped[bool] = mapped_column(Boolean, default=False)  # Flag to mark canceled transactions
+    payment_reference: Mapped[str] = mapped_column(String(255), nullable=True, unique=True, index=True)  # Stripe checkout session id, one transaction per payment
 
     client = relationship('Client')
     store_account = relationship('StoreAccount', back_populates='transactions')
@@ -131,6 +152,7 @@ class Transaction(db.Model):
 # Transaction Items Table (For Multi-Product Transactions)
 class TransactionItem(db.Model):
     __tablename__ = 'transaction_items'
+    __table_args__ = (db.Index('ix_transaction_items_transaction_id', 'transaction_id'),)
     t_item_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     transaction_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('transactions.transaction_id'), nullable=False)
     product_id: Mapped[int] = mapped_column(Integer, db.ForeignKey('products.product_id'), nullable=False)
@@ -165,6 +187,7 @@ class UserCart(db.Model):
     cart_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     client_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("clients.client_id"), unique=True, nullable=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")  # bumped by every cart write
 
     client = relationship("Client", back_populates="cart")
     cart_items = relationship("CartItem", back_populates="cart", cascade="all, delete-orphan")
@@ -172,6 +195,7 @@ class UserCart(db.Model):
 # CartItem Table (Stores Products Added to the Cart)
 class CartItem(db.Model):
     __tablename__ = "cart_items"
+    __table_args__ = (db.Index('ix_cart_items_cart_id_product_id', 'cart_id', 'product_id'),)
     c_item_id: Mapped[int] = mapped_column(Integer, primary_key=True)
     cart_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("user_carts.cart_id"), nullable=False)
     product_id: Mapped[int] = mapped_column(Integer, db.ForeignKey("products.product_id"), nullable=False)
@@ -181,6 +205,15 @@ class CartItem(db.Model):
     cart = relationship("UserCart", back_populates="cart_items")
     product = relationship("Product")
 
+# CatalogChange Table (Product, Inventory and Department changes, read by the other worker processes to refresh their caches)
+class CatalogChange(db.Model):
+    __tablename__ = "catalog_changes"
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True)
+    origin: Mapped[str] = mapped_column(String(16), nullable=False)  # process token of the writer
+    model: Mapped[str] = mapped_column(String(20), nullable=False)
+    key: Mapped[int] = mapped_column(Integer, nullable=True)  # product id, or department id
+    changed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+
 # class UserCartManager:
 #     def __init__(self, client_id):
 #         self.client_id = client_id
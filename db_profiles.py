@@ -0,0 +1,62 @@
+import os
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+
+# Named database engine profiles, picked with DATABASE_PROFILE (.env):
+#   sqlite  the local instance/retail.db file in WAL mode, tuned for concurrent readers and one writer (default)
+#   url     any SQLAlchemy DATABASE_URL (e.g. postgresql://...) with a sized, pre-pinged connection pool
+DATABASE_PROFILE = os.environ.get("DATABASE_PROFILE", "sqlite")
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))  # wait for a writer instead of "database is locked"
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes of the file read through mmap
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", 64 * 1024))  # page cache per connection
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))  # seconds, below the server's idle connection timeout
+
+
+def _tune_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers keep reading while checkout writes; NORMAL only syncs at checkpoints, which is safe in WAL
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.close()
+
+
+def configure_database(app, profile=DATABASE_PROFILE):
+    """ Sets the database URI and engine options of app for the named profile and logs the active one.
+    Must run before db.init_app. Raises ValueError for unknown profiles or a url profile without DATABASE_URL. """
+    if profile == "sqlite":
+        os.makedirs(app.instance_path, exist_ok=True)
+        uri = f"sqlite:///{os.path.join(app.instance_path, 'retail.db')}"
+        options = {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}}
+        if not event.contains(Engine, "connect", _tune_sqlite):
+            event.listen(Engine, "connect", _tune_sqlite)
+        details = (f"WAL, synchronous=NORMAL, busy_timeout={SQLITE_BUSY_TIMEOUT_MS}ms, "
+                   f"mmap_size={SQLITE_MMAP_SIZE}, cache_size={SQLITE_CACHE_SIZE_KB}KiB")
+    elif profile == "url":
+        uri = os.environ.get("DATABASE_URL")
+        if not uri:
+            raise ValueError("DATABASE_PROFILE=url needs DATABASE_URL")
+        options = {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": True,
+        }
+        details = f"pool_size={DB_POOL_SIZE}, max_overflow={DB_MAX_OVERFLOW}, pool_recycle={DB_POOL_RECYCLE}s, pre_ping"
+    else:
+        raise ValueError(f"Unknown DATABASE_PROFILE {profile!r}, expected 'sqlite' or 'url'")
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    app.logger.info("database profile %s: %s (%s)", profile, make_url(uri).render_as_string(hide_password=True), details)
+    return profile
@@ -0,0 +1,194 @@
+from collections import namedtuple
+from threading import Lock
+from urllib.parse import urlencode
+from sqlalchemy import select, func, case, and_, or_
+from database import db, Product, Inventory
+from catalog import ProductCard
+from cache import changes
+
+
+# Brand, product family and price range filters for the department pages. The filter state lives
+# in the query string (?brand=Fender&brand=Gibson&family=Bass&price=100-250&sort=price), written
+# in one canonical order so every combination has exactly one url and one cache entry.
+PRICE_RANGES = {  # key -> (lowest price, first price above the range)
+    "0-100": (None, 100),
+    "100-250": (100, 250),
+    "250-500": (250, 500),
+    "500-1000": (500, 1000),
+    "1000-": (1000, None),
+}
+SORTS = {  # key -> label; "" keeps the catalog order (product id)
+    "": "Featured",
+    "price": "Price: low to high",
+    "-price": "Price: high to low",
+    "newest": "Newest arrivals",
+}
+MAX_VALUES = 20  # selected values per facet that are honoured
+
+Filters = namedtuple("Filters", ["brands", "families", "prices", "sort"])
+FacetValue = namedtuple("FacetValue", ["value", "label", "count", "selected", "args"])
+NO_FILTERS = Filters((), (), (), "")
+
+
+def parse(args):
+    """ Reads the filters from request.args, dropping unknown price ranges and sort orders. """
+    values = lambda name: tuple(sorted({value for value in args.getlist(name) if value}))[:MAX_VALUES]
+    sort = args.get("sort", "")
+    return Filters(
+        brands=values("brand"),
+        families=values("family"),
+        prices=tuple(key for key in PRICE_RANGES if key in args.getlist("price")),
+        sort=sort if sort in SORTS else "",
+    )
+
+
+def query_args(filters):
+    """ The url_for() keyword arguments of filters, in canonical order. """
+    args = {"brand": list(filters.brands), "family": list(filters.families), "price": list(filters.prices), "sort": filters.sort}
+    return {name: value for name, value in args.items() if value}
+
+
+def canonical(filters):
+    """ The canonical query string of filters, "" when nothing is filtered or sorted. """
+    return urlencode(query_args(filters), doseq=True)
+
+
+def _toggled(filters, field, value):
+    current = getattr(filters, field)
+    values = tuple(v for v in current if v != value) if value in current else current + (value,)
+    if field == "prices":
+        values = tuple(key for key in PRICE_RANGES if key in values)
+    else:
+        values = tuple(sorted(values))
+    return query_args(filters._replace(**{field: values}))
+
+
+def sort_options(filters):
+    """ (key, label, selected, url_for arguments) of every sort order, keeping the current filters. """
+    return [(key, label, key == filters.sort, query_args(filters._replace(sort=key))) for key, label in SORTS.items()]
+
+
+def price_label(key):
+    low, high = PRICE_RANGES[key]
+    if low is None:
+        return f"Under ${high}"
+    if high is None:
+        return f"${low} and up"
+    return f"${low} to ${high}"
+
+
+def _price_bucket():
+    """ SQL expression giving the PRICE_RANGES key of Product.price. """
+    return case(
+        *[(Product.price < high, key) for key, (low, high) in PRICE_RANGES.items() if high is not None],
+        else_=next(key for key, (low, high) in PRICE_RANGES.items() if high is None),
+    )
+
+
+def _price_condition(keys):
+    ranges = []
+    for key in keys:
+        low, high = PRICE_RANGES[key]
+        bounds = []
+        if low is not None:
+            bounds.append(Product.price >= low)
+        if high is not None:
+            bounds.append(Product.price < high)
+        ranges.append(and_(*bounds))
+    return or_(*ranges)
+
+
+def products(department_id, filters):
+    """ Returns the in-stock ProductCards of a department that pass filters, in the chosen order. """
+    query = (
+        select(Product.product_id, Product.department_id, Product.description, Product.brand,
+               Product.price, Product.image_url, Inventory.quantity)
+        .join(Inventory, Inventory.product_id == Product.product_id)
+        .where(Product.department_id == department_id, Inventory.quantity > 0)
+    )
+    if filters.brands:
+        query = query.where(Product.brand.in_(filters.brands))
+    if filters.families:
+        query = query.where(Product.product_family.in_(filters.families))
+    if filters.prices:
+        query = query.where(_price_condition(filters.prices))
+    order = {
+        "": [Product.product_id],
+        "price": [Product.price, Product.product_id],
+        "-price": [Product.price.desc(), Product.product_id],
+        "newest": [Inventory.acquired_date.desc(), Product.product_id.desc()],
+    }[filters.sort]
+    return [ProductCard(*row) for row in db.session.execute(query.order_by(*order))]
+
+
+# In-stock product counts of every department by (brand, product family, price range), from one
+# GROUP BY query per department that is kept until a Product or Inventory row is committed. Facet
+# counts are sums over these groups: each facet's counts apply the other facets' filters but not
+# its own, so selecting a brand still shows how many products the other brands would add.
+class FacetCounts:
+    def __init__(self):
+        self._groups = {}  # department_id -> [(brand, family, price key, count)]
+        self._generation = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def groups(self, department_id):
+        groups = self._groups.get(department_id)
+        if groups is not None:
+            self.hits += 1
+            return groups
+        self.misses += 1
+        generation = self._generation
+        bucket = _price_bucket()
+        rows = db.session.execute(
+            select(Product.brand, Product.product_family, bucket, func.count())
+            .join(Inventory, Inventory.product_id == Product.product_id)
+            .where(Product.department_id == department_id, Inventory.quantity > 0)
+            .group_by(Product.brand, Product.product_family, bucket)
+        ).all()
+        groups = [tuple(row) for row in rows]
+        with self._lock:
+            if generation == self._generation:  # a commit that landed meanwhile leaves it to the next request
+                self._groups[department_id] = groups
+        return groups
+
+    def facets(self, department_id, filters):
+        """ Returns {"brand": [FacetValue], "family": [...], "price": [...]} for the department. Values
+        nothing would match are left out unless they are selected. """
+        groups = self.groups(department_id)
+        passes = {
+            "brands": lambda group: not filters.brands or group[0] in filters.brands,
+            "families": lambda group: not filters.families or group[1] in filters.families,
+            "prices": lambda group: not filters.prices or group[2] in filters.prices,
+        }
+        facets = {}
+        for name, field, position in (("brand", "brands", 0), ("family", "families", 1), ("price", "prices", 2)):
+            others = [check for other, check in passes.items() if other != field]
+            counts = {}
+            for group in groups:
+                if group[position] is not None:
+                    counts.setdefault(group[position], 0)
+                    if all(check(group) for check in others):
+                        counts[group[position]] += group[3]
+            selected = getattr(filters, field)
+            values = [key for key in PRICE_RANGES if key in counts or key in selected] if field == "prices" \
+                else sorted(set(counts) | set(selected), key=str.lower)
+            facets[name] = [
+                FacetValue(value, price_label(value) if field == "prices" else value, counts.get(value, 0),
+                           value in selected, _toggled(filters, field, value))
+                for value in values if counts.get(value) or value in selected
+            ]
+        return facets
+
+    def invalidate(self, keys=None):
+        with self._lock:
+            self._generation += 1
+            self._groups = {}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+facet_counts = FacetCounts()
+changes.subscribe([Product, Inventory], facet_counts.invalidate)
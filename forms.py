@@ -1,9 +1,39 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, PasswordField, URLField, IntegerField, DecimalField, SelectField
-from wtforms.validators import DataRequired, URL, Regexp, Length, Email, NumberRange
-from database import db, Product, Client, Department, Inventory
-from sqlalchemy import select
+from wtforms.validators import DataRequired, URL, Regexp, Length, Email, NumberRange, ValidationError
+from wtforms.widgets import TextInput
 from flask_login import current_user    
+import catalog
+import lookups
+
+
+# Id of a row in a large table (lookups.LOOKUPS[source]), typed with the help of the autocomplete
+# endpoint instead of picked from a <select> holding the whole table. The submitted id is checked with
+# one primary key lookup, and the row's label is shown under the field.
+class LookupField(IntegerField):
+    widget = TextInput()
+
+    def __init__(self, label=None, validators=None, source=None, **kwargs):
+        super().__init__(label, validators, **kwargs)
+        self.lookup = lookups.LOOKUPS[source]
+        self.render_kw = {"autocomplete": "off", "data-autocomplete": source, **(self.render_kw or {})}
+
+    def pre_validate(self, form):
+        if self.data is not None:
+            label = self.lookup.label_of(self.data)
+            if label is None:
+                raise ValidationError(f"No {self.lookup.model.__tablename__[:-1]} with id {self.data}.")
+            self.description = label
+
+    def show_label(self):
+        """ Puts the label of the current id under the field (for forms filled from a record). """
+        if self.data is not None and not self.description:
+            self.description = self.lookup.label_of(self.data) or ""
+
+
+def department_choices():
+    # departments are few and already cached by the catalog, which reloads them after any Department commit
+    return [(entry.department_id, entry.name) for entry in catalog.departments.all()]
 
 # Create a form to register new users
 class RegisterForm(FlaskForm):
@@ -65,7 +95,7 @@ class ProductForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.department_id.choices = [(c.department_id, f"{c.name}") for c in db.session.scalars(select(Department)).all()]
+        self.department_id.choices = department_choices()
 
 
 # create a form to update departments
@@ -76,8 +106,8 @@ class DepartmentForm(FlaskForm):
 # create a form to update transactions
 class TransactionForm(FlaskForm):
     """Form for creating or updating transactions."""
-    client_id = SelectField("Client", validators=[DataRequired()], coerce=int)
-    product_id = SelectField("Product", validators=[DataRequired()], coerce=int)
+    client_id = LookupField("Client", validators=[DataRequired()], source="clients")
+    product_id = LookupField("Product", validators=[DataRequired()], source="products")
     transaction_type = SelectField("Buy or Sell", choices=[("buy", "Buy"), ("sell", "Sell")])
     department_id = SelectField("Department", coerce=int)
     quantity = IntegerField("Quantity", validators=[DataRequired(), NumberRange(min=0)])
@@ -90,10 +120,10 @@ class TransactionForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.client_id.choices = [(c.client_id, f"{c.first_name} {c.last_name}") for c in db.session.scalars(select(Client)).all()]
-        self.product_id.choices = [(p.product_id, p.description) for p in db.session.scalars(select(Product)).all()]
-        if current_user.is_authenticated and current_user.employee:self.department_id.choices = [(d.department_id, d.name) 
-                                          for d in db.session.scalars(select(Department)).all()]
+        self.client_id.show_label()
+        self.product_id.show_label()
+        if current_user.is_authenticated and current_user.employee:
+            self.department_id.choices = department_choices()
         else:
             self.department_id.choices = []  # Hide department selection for non-employees
 
@@ -109,16 +139,13 @@ class PaymentForm(FlaskForm):
 
 # create a form to update inventory
 class InventoryForm(FlaskForm):
-    product_id = SelectField(
-        "Product",
-        validators=[DataRequired()],
-    )
+    product_id = LookupField("Product", validators=[DataRequired()], source="products")
     quantity = IntegerField("Quantity", validators=[DataRequired(), NumberRange(min=0)])
     department = StringField("Department", validators=[DataRequired()])
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.product_id.choices = [(c.product_id, f"{c.product.description}") for c in db.session.scalars(select(Inventory)).all()]
+        self.product_id.show_label()
 
         
 
@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import OrderedDict
+from markupsafe import Markup
+from database import Product, Inventory, Department
+from cache import changes
+
+
+FRAGMENT_CACHE_BYTES = int(os.environ.get("FRAGMENT_CACHE_BYTES", 16 * 1024 * 1024))  # rendered markup kept per process
+SLOT = "<!--slot-->"  # where per-visitor markup (e.g. the add-to-cart form) goes into a cached fragment
+
+
+# Least recently used cache of rendered template fragments, bounded by the total UTF-8 size of the markup.
+# Keys are tuples whose first item names the fragment kind ("card", "grid"); the second is the
+# product or department id the fragment shows.
+class FragmentCache:
+    def __init__(self, max_bytes=FRAGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0  # bytes
+        self._fragments = OrderedDict()  # key -> (fragment, bytes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                self.misses += 1
+                return None
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment[0]
+
+    def put(self, key, fragment):
+        fragment = Markup(fragment)
+        size = len(fragment.encode())
+        if size > self.max_bytes:
+            return fragment
+        with self._lock:
+            old = self._fragments.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._fragments[key] = (fragment, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self._fragments.popitem(last=False)[1][1]
+        return fragment
+
+    def render(self, key, render):
+        """ Returns the cached fragment for key, calling render() to make it on a miss. """
+        fragment = self.get(key)
+        if fragment is None:
+            fragment = self.put(key, render())
+        return fragment
+
+    def invalidate(self, kind, ids):
+        """ Drops the fragments of the given kind showing any of ids. """
+        ids = set(ids)
+        with self._lock:
+            for key in [key for key in self._fragments if key[0] == kind and key[1] in ids]:
+                self.size -= self._fragments.pop(key)[1]
+
+    def clear(self, keys=None):
+        with self._lock:
+            self._fragments.clear()
+            self.size = 0
+
+    def products_changed(self, product_ids):
+        # a product may have moved between departments, so every grid goes with its cards
+        self.invalidate("card", product_ids)
+        with self._lock:
+            for key in [key for key in self._fragments if key[0] == "grid"]:
+                self.size -= self._fragments.pop(key)[1]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._fragments), "bytes": self.size}
+
+
+def fill_slot(fragment, markup):
+    """ Puts per-visitor markup into the SLOT of a cached fragment. """
+    return Markup(str(fragment).replace(SLOT, str(markup), 1))  # str: Markup.replace would escape the form
+
+
+fragment_cache = FragmentCache()
+changes.subscribe([Product, Inventory], fragment_cache.products_changed, key=lambda obj: obj.product_id)
+changes.subscribe([Department], fragment_cache.clear)
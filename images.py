@@ -0,0 +1,109 @@
+import hashlib
+import os
+from threading import Lock
+from PIL import Image, ImageOps, UnidentifiedImageError
+from werkzeug.security import safe_join
+
+Image.init()  # register every format plugin, so can_resize sees them all
+
+
+# Resized, recompressed WebP copies of the product and banner images in static/. They are made on
+# first request (or ahead of time with "flask build-images") and cached on disk under a name that
+# includes a hash of the original, so a replaced original gets new urls and browsers may cache
+# derivatives forever.
+DERIVATIVE_WIDTHS = {"thumbnail": 160, "card": 480, "full": 1200}  # pixels
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 80))  # WebP quality of the derivatives
+
+
+class ImagePipeline:
+    def __init__(self, static_folder, cache_folder):
+        self.static_folder = static_folder
+        self.cache_folder = cache_folder
+        self._digests = {}  # path -> (mtime_ns, size, digest)
+        self._lock = Lock()
+
+    @staticmethod
+    def can_resize(filename):
+        """ True when Pillow reads the original's format (e.g. not .avif without a plugin). """
+        return os.path.splitext(filename)[1].lower() in Image.registered_extensions()
+
+    def source_digest(self, filename):
+        """ Returns a short hash of static/<filename>, or None when it is missing. Hashes are
+        remembered until the file's modification time or size changes. """
+        path = safe_join(self.static_folder, filename)  # None for names reaching outside static/
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        cached = self._digests.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()[:16]
+        try:
+            with Image.open(path) as image:  # reads the header only
+                width = image.width
+        except (OSError, UnidentifiedImageError):
+            width = None
+        self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest, width)
+        return digest
+
+    def widths(self, filename):
+        """ Returns {size: pixel width} of the derivatives of a resizable original. Sizes at least as wide
+        as the original all come out at the original width, so only the smallest of them is listed. """
+        if self.source_digest(filename) is None:
+            return {}
+        original = self._digests[safe_join(self.static_folder, filename)][3]
+        widths = {}
+        for size, width in DERIVATIVE_WIDTHS.items():
+            widths[size] = min(width, original or width)
+            if original and width >= original:
+                break
+        return widths
+
+    def derivative_path(self, filename, size):
+        """ Returns the cached derivative of static/<filename> at size, making it first if needed.
+        Raises KeyError for unknown sizes and ValueError for missing or unreadable originals. """
+        width = DERIVATIVE_WIDTHS[size]
+        digest = self.source_digest(filename)
+        if digest is None:
+            raise ValueError(f"{filename} not found")
+        path = os.path.join(self.cache_folder, f"{digest}-{size}.webp")
+        if os.path.exists(path):
+            return path
+        with self._lock:
+            if not os.path.exists(path):
+                self._resize(safe_join(self.static_folder, filename), path, width)
+        return path
+
+    @staticmethod
+    def _resize(source, target, width):
+        try:
+            with Image.open(source) as image:
+                image = ImageOps.exif_transpose(image)
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+                if image.width > width:
+                    image.thumbnail((width, round(image.height * width / image.width)), Image.LANCZOS)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                partial = f"{target}.{os.getpid()}.tmp"
+                image.save(partial, "WEBP", quality=IMAGE_QUALITY, method=4)
+                os.replace(partial, target)
+        except (OSError, UnidentifiedImageError) as e:
+            raise ValueError(f"cannot resize {source}: {e}")
+
+    def build(self, filenames):
+        """ Makes every derivative of filenames ahead of time. Returns (made, failed filenames). """
+        made, failed = 0, []
+        for filename in filenames:
+            try:
+                for size in DERIVATIVE_WIDTHS:
+                    self.derivative_path(filename, size)
+                    made += 1
+            except ValueError:
+                failed.append(filename)
+        return made, failed
@@ -0,0 +1,247 @@
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import select, insert, update
+from sqlalchemy.orm import Session
+from database import db, Product, Department, Inventory
+from cache import changes
+
+
+CHUNK_SIZE = 1000
+
+# spreadsheet headers and the product/inventory fields they fill
+HEADER_ALIASES = {
+    "description": "description",
+    "brand": "brand",
+    "website": "website_url",
+    "website_url": "website_url",
+    "image": "image_url",
+    "image_url": "image_url",
+    "price": "price",
+    "cost": "cost",
+    "product_family": "product_family",
+    "family": "product_family",
+    "department": "department",
+    "quantity": "quantity",
+    "stripe_product_code": "stripe_product_code",
+    "stripe_price_code": "stripe_price_code",
+}
+REQUIRED_FIELDS = ("description", "website_url", "image_url", "price", "cost", "department")
+# only written when the sheet has the column, so a partial sheet keeps the stored values
+OPTIONAL_FIELDS = ("brand", "product_family", "stripe_product_code", "stripe_price_code")
+
+
+class MissingHeader(ValueError):
+    """ The sheet has no header row naming the description column, so none of its rows can be read. """
+
+
+def read_rows(source):
+    """ Yields the rows of an .xlsx or .csv file one at a time, without loading the whole sheet.
+    source is a path or a (filename, file object) pair from an upload. """
+    filename, stream = source if isinstance(source, tuple) else (source, None)
+    if filename.lower().endswith(".csv"):
+        with open(filename, newline="", encoding="utf-8-sig") if stream is None else _text(stream) as f:
+            yield from csv.reader(f)
+        return
+    from openpyxl import load_workbook  # only needed for spreadsheets
+    workbook = load_workbook(stream or filename, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def _text(stream):
+    return io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+
+
+def parse_rows(rows):
+    """ Finds the header row (the first one with a description column) and yields (line, record) pairs.
+    Raises MissingHeader when no row has one. """
+    header = None
+    for line, row in enumerate(rows, start=1):
+        cells = ["" if value is None else str(value).strip() for value in row]
+        if header is None:
+            names = [HEADER_ALIASES.get(cell.lower()) for cell in cells]
+            if "description" in names:
+                header = names
+            continue
+        if not any(cells):
+            continue
+        yield line, {name: cell for name, cell in zip(header, cells) if name}
+    if header is None:
+        raise MissingHeader("no header row with a description column was found")
+
+
+def clean_record(record):
+    """ Converts a raw spreadsheet record into typed values. Raises ValueError with the rejection reason. """
+    missing = [field for field in REQUIRED_FIELDS if not record.get(field)]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    try:
+        price = Decimal(record["price"])
+        cost = Decimal(record["cost"])
+        quantity = int(Decimal(record.get("quantity") or 0))
+    except (InvalidOperation, ValueError):
+        raise ValueError("price, cost and quantity must be numbers")
+    if price < 0 or cost < 0 or quantity < 0:
+        raise ValueError("price, cost and quantity can't be negative")
+    cleaned = {
+        "description": record["description"],
+        "website_url": record["website_url"],
+        "image_url": record["image_url"],
+        "price": price,
+        "cost": cost,
+        "department": record["department"].title(),
+    }
+    cleaned.update({field: record[field] for field in OPTIONAL_FIELDS if field in record})
+    if "quantity" in record:  # without the column existing stock is left alone
+        cleaned["quantity"] = quantity
+    return cleaned
+
+
+def _department_ids(session, names):
+    """ Maps department names to ids, inserting the missing departments in one statement. """
+    found = dict(session.execute(select(Department.name, Department.department_id).where(Department.name.in_(names))).all())
+    missing = [{"name": name} for name in names if name not in found]
+    if missing:
+        session.execute(insert(Department), missing)
+        found.update(session.execute(select(Department.name, Department.department_id).where(Department.name.in_(names))).all())
+        changes.touch(session, Department, found.values())
+    return found
+
+
+def _upsert_chunk(session, records):
+    """ Upserts one chunk of products (keyed by website_url) and their inventory with executemany statements. """
+    records = {record["website_url"]: record for record in records}  # the last row of a duplicated product wins
+    department_ids = _department_ids(session, {record["department"] for record in records.values()})
+    now = datetime.utcnow()
+
+    products = []
+    for record in records.values():
+        product = {key: value for key, value in record.items() if key not in ("department", "quantity")}
+        product["department_id"] = department_ids[record["department"]]
+        products.append(product)
+
+    urls = list(records)
+    existing = dict(session.execute(select(Product.website_url, Product.product_id).where(Product.website_url.in_(urls))).all())
+    old_products = [dict(product, product_id=existing[product["website_url"]]) for product in products if product["website_url"] in existing]
+    new_products = [dict(dict.fromkeys(OPTIONAL_FIELDS, ""), **product) for product in products if product["website_url"] not in existing]
+    if new_products:
+        session.execute(insert(Product), new_products)
+        existing = dict(session.execute(select(Product.website_url, Product.product_id).where(Product.website_url.in_(urls))).all())
+    if old_products:
+        session.execute(update(Product), old_products)
+
+    product_ids = {url: existing[url] for url in urls}
+    stocked = dict(session.execute(select(Inventory.product_id, Inventory.inventory_id).where(Inventory.product_id.in_(product_ids.values()))).all())
+    new_stock, old_stock = [], []
+    for url, record in records.items():
+        product_id = product_ids[url]
+        if product_id not in stocked:
+            new_stock.append({"product_id": product_id, "quantity": record.get("quantity", 0), "acquired_date": now, "last_updated": now})
+        elif "quantity" in record:
+            old_stock.append({"inventory_id": stocked[product_id], "quantity": record["quantity"], "last_updated": now})
+    if new_stock:
+        session.execute(insert(Inventory), new_stock)
+    if old_stock:
+        session.execute(update(Inventory), old_stock)
+
+    # bulk statements bypass the unit of work, so tell the catalog caches which products changed
+    changes.touch(session, Product, product_ids.values())
+    changes.touch(session, Inventory, product_ids.values())
+    return len(records)
+
+
+def import_inventory(source, rejects_path=None, chunk_size=CHUNK_SIZE, session=None):
+    """ Streams a product spreadsheet into Product, Department and Inventory, one transaction per chunk.
+    Rejected rows are written to rejects_path as CSV along with the reason. Returns the import statistics;
+    raises MissingHeader for a sheet without a description column. """
+    session = session or db.session
+    started = time.perf_counter()
+    stats = {"rows": 0, "imported": 0, "rejected": 0}
+    rejects_file = rejects_writer = None
+    chunk = []
+
+    def flush():
+        stats["imported"] += _upsert_chunk(session, chunk)
+        session.commit()
+        chunk.clear()
+
+    try:
+        for line, record in parse_rows(read_rows(source)):
+            stats["rows"] += 1
+            try:
+                chunk.append(clean_record(record))
+            except ValueError as e:
+                stats["rejected"] += 1
+                if rejects_path:
+                    if rejects_writer is None:
+                        rejects_file = open(rejects_path, "w", newline="")
+                        rejects_writer = csv.writer(rejects_file)
+                        rejects_writer.writerow(["line", "reason", "record"])
+                    rejects_writer.writerow([line, str(e), record])
+                continue
+            if len(chunk) >= chunk_size:
+                flush()
+        if chunk:
+            flush()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        if rejects_file:
+            rejects_file.close()
+
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    stats["rows_per_sec"] = round(stats["rows"] / stats["seconds"]) if stats["seconds"] else stats["rows"]
+    stats["rejects_path"] = os.path.abspath(rejects_path) if rejects_path and stats["rejected"] else None
+    return stats
+
+
+CHECK_PRODUCT = {
+    "description": "Import check probe", "brand": "Probe brand", "website_url": "https://example.invalid/import-check",
+    "image_url": "probe.png", "price": "10.00", "cost": "5.00", "product_family": "Probe family",
+    "stripe_product_code": "prod_probe", "stripe_price_code": "price_probe", "department": "Import Check", "quantity": "3",
+}
+
+
+def _csv_source(fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    writer.writerow([CHECK_PRODUCT[field] for field in fields])
+    return "check.csv", io.BytesIO(buffer.getvalue().encode())
+
+
+def _stored(session):
+    return session.execute(
+        select(*(getattr(Product, field) for field in OPTIONAL_FIELDS), Inventory.quantity)
+        .join(Inventory, Inventory.product_id == Product.product_id)
+        .where(Product.website_url == CHECK_PRODUCT["website_url"])
+    ).one()._asdict()
+
+
+def check_partial_reimport():
+    """ Imports a probe product from a full sheet, re-imports it from a sheet with only the required columns
+    and returns {field: (before, after)} for the stored values the second import changed. Both imports run
+    in a transaction that is rolled back, so the database is left as it was. """
+    with db.engine.connect() as connection:
+        transaction = connection.begin()
+        if connection.dialect.name == "sqlite":
+            # pysqlite defers BEGIN, and releasing a SAVEPOINT opened outside a transaction would commit it
+            connection.exec_driver_sql("BEGIN")
+        session = Session(bind=connection, join_transaction_mode="create_savepoint")
+        try:
+            import_inventory(_csv_source(list(CHECK_PRODUCT)), session=session)
+            before = _stored(session)
+            import_inventory(_csv_source(REQUIRED_FIELDS), session=session)
+            after = _stored(session)
+            return {field: (value, after[field]) for field, value in before.items() if after[field] != value}
+        finally:
+            session.close()
+            transaction.rollback()
@@ -0,0 +1,50 @@
+from sqlalchemy import select, func
+from sqlalchemy.inspection import inspect
+from database import db, Product, Client
+
+
+# Id pickers for tables too large to put in a <select>: the admin forms ask the autocomplete
+# endpoint for a few matches while the employee types, and the submitted id is checked with one
+# primary key lookup.
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+
+
+class Lookup:
+    def __init__(self, model, label, prefix_columns):
+        self.model = model
+        self.label = label  # SQL expression shown for a row
+        self.prefix_columns = prefix_columns  # each with a lower(column) index
+        self.primary_key = inspect(model).primary_key[0]
+
+    def label_of(self, record_id):
+        """ Returns the label of the row with primary key record_id, or None when there is none. """
+        return db.session.scalar(select(self.label).where(self.primary_key == record_id))
+
+    def suggest(self, text, limit=AUTOCOMPLETE_LIMIT):
+        """ Returns up to limit (id, label) pairs whose id equals text or whose prefix columns start
+        with it, ignoring case. Each column is read in index order, so no query sorts more than limit rows. """
+        text = text.strip().lower()
+        if not text:
+            return []
+        limit = max(1, min(limit, MAX_AUTOCOMPLETE_LIMIT))
+        found = {}
+        if text.isdigit():
+            found.update(db.session.execute(select(self.primary_key, self.label).where(self.primary_key == int(text))).all())
+        for column in self.prefix_columns:
+            key = func.lower(column)
+            rows = db.session.execute(
+                select(self.primary_key, self.label)
+                .where(key >= text, key < text + "\U0010ffff")
+                .order_by(key, self.primary_key)
+                .limit(limit)
+            ).all()
+            for record_id, label in rows:
+                found.setdefault(record_id, label)
+        return sorted(found.items(), key=lambda item: (str(item[1]).lower(), item[0]))[:limit]
+
+
+LOOKUPS = {
+    "clients": Lookup(Client, Client.first_name + " " + Client.last_name, [Client.first_name, Client.last_name]),
+    "products": Lookup(Product, Product.description, [Product.description]),
+}
@@ -0,0 +1,90 @@
+import os
+import time
+from flask import g, request
+from prometheus_client import (Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest,
+                               CONTENT_TYPE_LATEST, multiprocess, disable_created_metrics)
+
+
+# Prometheus metrics of the store. Every worker process updates its own counters (prometheus_client
+# guards each value with a short per-metric mutex, so there is no shared state between processes);
+# with several workers (gunicorn etc.) set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by
+# them before starting, and /metrics sums the values of all live processes.
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+CACHE_STATS_SECONDS = 1.0  # how often a process republishes its cache counters
+# addresses that may scrape /metrics without logging in (as seen by Flask, i.e. the proxy's behind one)
+ALLOWED_SCRAPERS = {ip.strip() for ip in os.environ.get("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",") if ip.strip()}
+
+disable_created_metrics()  # no *_created series next to every counter
+
+REQUESTS = Counter("store_http_requests_total", "Requests handled, by endpoint, method and status.",
+                   ["endpoint", "method", "status"])
+LATENCY = Histogram("store_http_request_seconds", "Request latency by endpoint.", ["endpoint"])
+DB_STATEMENTS = Counter("store_db_statements_total", "SQL statements run by requests, by endpoint.", ["endpoint"])
+DB_SECONDS = Counter("store_db_seconds_total", "Time requests spent in SQL statements, by endpoint.", ["endpoint"])
+CHECKOUTS = Counter("store_checkout_outcomes_total", "Checkout and payment webhook outcomes.", ["outcome"])
+CACHE_HITS = Gauge("store_cache_hits", "Process-local cache hits since start.", ["cache"], multiprocess_mode="livesum")
+CACHE_MISSES = Gauge("store_cache_misses", "Process-local cache misses since start.", ["cache"], multiprocess_mode="livesum")
+
+
+_caches = {}  # name -> object with stats() returning hits and misses
+_published = [0.0]
+
+
+def checkout_outcome(outcome):
+    CHECKOUTS.labels(outcome).inc()
+
+
+def publish_cache_stats():
+    _published[0] = time.monotonic()
+    for name, cache in _caches.items():
+        stats = cache.stats()
+        CACHE_HITS.labels(name).set(stats["hits"])
+        CACHE_MISSES.labels(name).set(stats["misses"])
+
+
+def registry():
+    """ The registry /metrics renders: this process's, or the merged one of every worker process. """
+    if not MULTIPROCESS:
+        return REGISTRY
+    merged = CollectorRegistry()
+    multiprocess.MultiProcessCollector(merged)
+    return merged
+
+
+def render():
+    """ Returns (body, content type) of the metrics in Prometheus text format. """
+    publish_cache_stats()
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def init_app(app, caches):
+    """ Times and counts every request by endpoint (unmatched urls are counted as "unmatched"), including
+    the ones that end in an unhandled exception, and publishes the hits/misses of caches
+    ({name: object with stats()}) at most every CACHE_STATS_SECONDS. """
+    _caches.update(caches)
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def remember_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    # teardown runs for every request, also when an exception skipped the after_request functions
+    @app.teardown_request
+    def record_request(exc):
+        started = g.get("metrics_started")
+        if started is None:
+            return
+        endpoint = request.url_rule.endpoint if request.url_rule else "unmatched"
+        status = 500 if exc is not None else g.get("metrics_status", 500)
+        LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+        REQUESTS.labels(endpoint, request.method, status).inc()
+        queries = g.get("queries")
+        if queries is not None:
+            DB_STATEMENTS.labels(endpoint).inc(queries.count)
+            DB_SECONDS.labels(endpoint).inc(queries.seconds)
+        if time.monotonic() - _published[0] > CACHE_STATS_SECONDS:
+            publish_cache_stats()
@@ -0,0 +1,33 @@
+"""Widened users.password for hash upgrades
+
+Revision ID: 3b8e5d20c6f1
+Revises: 7f3c2a91d4b6
+Create Date: 2026-10-18 11:04:17.220391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b8e5d20c6f1'
+down_revision = '7f3c2a91d4b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # pbkdf2 hashes with 16 character salts are 103 characters long, scrypt hashes about 160
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password',
+               existing_type=sa.String(length=100),
+               type_=sa.String(length=255),
+               existing_nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.alter_column('password',
+               existing_type=sa.String(length=255),
+               type_=sa.String(length=100),
+               existing_nullable=False)
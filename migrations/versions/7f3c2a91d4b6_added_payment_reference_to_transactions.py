@@ -0,0 +1,29 @@
+"""Added payment_reference to transactions
+
+Revision ID: 7f3c2a91d4b6
+Revises: 5bd0c8eb5d8a
+Create Date: 2026-10-18 09:12:41.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3c2a91d4b6'
+down_revision = '5bd0c8eb5d8a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the unique index lets the payment webhook record each Stripe checkout session only once
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('payment_reference', sa.String(length=255), nullable=True))
+        batch_op.create_index(batch_op.f('ix_transactions_payment_reference'), ['payment_reference'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_transactions_payment_reference'))
+        batch_op.drop_column('payment_reference')
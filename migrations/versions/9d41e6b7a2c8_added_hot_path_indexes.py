@@ -0,0 +1,60 @@
+"""Added hot path indexes
+
+Revision ID: 9d41e6b7a2c8
+Revises: 3b8e5d20c6f1
+Create Date: 2026-10-18 13:26:52.908114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d41e6b7a2c8'
+down_revision = '3b8e5d20c6f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # foreign keys the catalog, login, cart, checkout and inventory queries filter on;
+    # user_carts.client_id is already indexed by its unique constraint
+    with op.batch_alter_table('cart_items', schema=None) as batch_op:
+        batch_op.create_index('ix_cart_items_cart_id_product_id', ['cart_id', 'product_id'], unique=False)
+
+    with op.batch_alter_table('inventory', schema=None) as batch_op:
+        batch_op.create_index('ix_inventory_product_id_quantity', ['product_id', 'quantity'], unique=False)
+        batch_op.create_index('ix_inventory_quantity', ['quantity'], unique=False)
+
+    with op.batch_alter_table('transaction_items', schema=None) as batch_op:
+        batch_op.create_index('ix_transaction_items_transaction_id', ['transaction_id'], unique=False)
+
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.create_index('ix_transactions_client_id_transaction_date', ['client_id', 'transaction_date'], unique=False)
+
+    with op.batch_alter_table('clients', schema=None) as batch_op:
+        batch_op.create_index('ix_clients_user_id', ['user_id'], unique=False)
+
+    with op.batch_alter_table('employees', schema=None) as batch_op:
+        batch_op.create_index('ix_employees_user_id', ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('employees', schema=None) as batch_op:
+        batch_op.drop_index('ix_employees_user_id')
+
+    with op.batch_alter_table('clients', schema=None) as batch_op:
+        batch_op.drop_index('ix_clients_user_id')
+
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.drop_index('ix_transactions_client_id_transaction_date')
+
+    with op.batch_alter_table('transaction_items', schema=None) as batch_op:
+        batch_op.drop_index('ix_transaction_items_transaction_id')
+
+    with op.batch_alter_table('inventory', schema=None) as batch_op:
+        batch_op.drop_index('ix_inventory_quantity')
+        batch_op.drop_index('ix_inventory_product_id_quantity')
+
+    with op.batch_alter_table('cart_items', schema=None) as batch_op:
+        batch_op.drop_index('ix_cart_items_cart_id_product_id')
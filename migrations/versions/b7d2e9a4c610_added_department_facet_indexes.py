@@ -0,0 +1,29 @@
+"""Added department facet indexes
+
+Revision ID: b7d2e9a4c610
+Revises: e5a7c3f19b24
+Create Date: 2026-10-18 15:11:08.602731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e9a4c610'
+down_revision = 'e5a7c3f19b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # plain CREATE INDEX rather than batch mode: a rebuilt products table would lose the search triggers
+    op.create_index('ix_products_department_id_brand', 'products', ['department_id', 'brand'], unique=False)
+    op.create_index('ix_products_department_id_product_family', 'products', ['department_id', 'product_family'], unique=False)
+    op.create_index('ix_products_department_id_price', 'products', ['department_id', 'price'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_products_department_id_price', table_name='products')
+    op.drop_index('ix_products_department_id_product_family', table_name='products')
+    op.drop_index('ix_products_department_id_brand', table_name='products')
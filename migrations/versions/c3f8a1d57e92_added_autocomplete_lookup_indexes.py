@@ -0,0 +1,29 @@
+"""Added autocomplete lookup indexes
+
+Revision ID: c3f8a1d57e92
+Revises: b7d2e9a4c610
+Create Date: 2026-10-18 16:20:44.187392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f8a1d57e92'
+down_revision = 'b7d2e9a4c610'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # case-insensitive prefix search of the admin form autocomplete
+    op.create_index('ix_products_description_lower', 'products', [sa.text('lower(description)')], unique=False)
+    op.create_index('ix_clients_first_name_lower', 'clients', [sa.text('lower(first_name)')], unique=False)
+    op.create_index('ix_clients_last_name_lower', 'clients', [sa.text('lower(last_name)')], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_clients_last_name_lower', table_name='clients')
+    op.drop_index('ix_clients_first_name_lower', table_name='clients')
+    op.drop_index('ix_products_description_lower', table_name='products')
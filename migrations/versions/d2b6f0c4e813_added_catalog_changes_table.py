@@ -0,0 +1,34 @@
+"""Added catalog changes table
+
+Revision ID: d2b6f0c4e813
+Revises: c3f8a1d57e92
+Create Date: 2026-10-18 19:05:12.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2b6f0c4e813'
+down_revision = 'c3f8a1d57e92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # catalog changes shared between worker processes (catalog.CatalogSync)
+    op.create_table('catalog_changes',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('origin', sa.String(length=16), nullable=False),
+    sa.Column('model', sa.String(length=20), nullable=False),
+    sa.Column('key', sa.Integer(), nullable=True),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    op.create_index(op.f('ix_catalog_changes_changed_at'), 'catalog_changes', ['changed_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_catalog_changes_changed_at'), table_name='catalog_changes')
+    op.drop_table('catalog_changes')
@@ -0,0 +1,59 @@
+"""Added product search index
+
+Revision ID: e5a7c3f19b24
+Revises: 9d41e6b7a2c8
+Create Date: 2026-10-18 14:02:37.415220
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c3f19b24'
+down_revision = '9d41e6b7a2c8'
+branch_labels = None
+depends_on = None
+
+# the statements are kept here, not imported from search.py, so later edits there don't rewrite history
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        description, brand, product_family,
+        content='products', content_rowid='product_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts_vocab USING fts5vocab(products_fts, row)",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, description, brand, product_family)
+        VALUES (new.product_id, new.description, new.brand, new.product_family);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, description, brand, product_family)
+        VALUES ('delete', old.product_id, old.description, old.brand, old.product_family);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF description, brand, product_family ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, description, brand, product_family)
+        VALUES ('delete', old.product_id, old.description, old.brand, old.product_family);
+        INSERT INTO products_fts(rowid, description, brand, product_family)
+        VALUES (new.product_id, new.description, new.brand, new.product_family);
+    END""",
+    "INSERT INTO products_fts(products_fts) VALUES ('rebuild')",
+]
+
+
+def upgrade():
+    # FTS5 exists only on SQLite; other databases are searched with LIKE
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for statement in FTS_SCHEMA:
+        op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("DROP TRIGGER IF EXISTS products_fts_update")
+    op.execute("DROP TRIGGER IF EXISTS products_fts_delete")
+    op.execute("DROP TRIGGER IF EXISTS products_fts_insert")
+    op.execute("DROP TABLE IF EXISTS products_fts_vocab")
+    op.execute("DROP TABLE IF EXISTS products_fts")
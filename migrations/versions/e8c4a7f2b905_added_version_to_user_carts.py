@@ -0,0 +1,27 @@
+"""Added version to user carts
+
+Revision ID: e8c4a7f2b905
+Revises: d2b6f0c4e813
+Create Date: 2026-10-18 19:48:31.220956
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c4a7f2b905'
+down_revision = 'd2b6f0c4e813'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # optimistic concurrency of the write-behind cart cache across worker processes
+    with op.batch_alter_table('user_carts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('user_carts', schema=None) as batch_op:
+        batch_op.drop_column('version')
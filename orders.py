@@ -0,0 +1,112 @@
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import select, insert, update, delete, case
+from sqlalchemy.exc import IntegrityError
+from database import Inventory, Transaction, TransactionItem, UserCart, CartItem
+from cache import changes
+
+
+OrderLine = namedtuple("OrderLine", ["product_id", "quantity", "price"])
+
+METADATA_VALUE_LIMIT = 500  # Stripe limits metadata values to 500 characters
+
+
+class OutOfStock(Exception):
+    """ Raised when at least one order line asks for more units than the inventory holds. """
+    def __init__(self, product_ids):
+        super().__init__(f"Not enough stock for products {sorted(product_ids)}")
+        self.product_ids = product_ids
+
+
+def order_quantities(items):
+    """ Sums the quantities of order lines (cart or transaction items) per product. """
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    return quantities
+
+
+def reserve_stock(session, quantities):
+    """ Decrements the inventory of every product in quantities ({product_id: units}) with a single
+    conditional UPDATE, so concurrent checkouts can never take stock below zero. Raises OutOfStock when
+    any line is short; the caller must then roll back, which also undoes the lines that did fit. """
+    requested = case(quantities, value=Inventory.product_id)
+    reserved = session.execute(
+        update(Inventory)
+        .where(Inventory.product_id.in_(quantities), Inventory.quantity >= requested)
+        .values(quantity=Inventory.quantity - requested, last_updated=datetime.utcnow())
+        .returning(Inventory.product_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    short = set(quantities) - set(reserved)
+    if short:
+        raise OutOfStock(short)
+    # the bulk UPDATE bypasses the unit of work, so tell the catalog caches which products changed
+    changes.touch(session, Inventory, quantities)
+
+
+def order_metadata(cart):
+    """ Snapshots the cart into Stripe checkout metadata so the payment webhook knows what was paid for. """
+    lines = ";".join(f"{item.product_id}:{item.quantity}:{item.price}" for item in cart.cart_items)
+    metadata = {"cart_id": str(cart.cart_id), "client_id": str(cart.client_id)}
+    for index in range(0, len(lines), METADATA_VALUE_LIMIT):
+        metadata[f"items_{index // METADATA_VALUE_LIMIT}"] = lines[index:index + METADATA_VALUE_LIMIT]
+    return metadata
+
+
+def parse_order_metadata(metadata):
+    """ Reverses order_metadata. Returns (cart_id, client_id, [OrderLine]). """
+    chunks = []
+    while f"items_{len(chunks)}" in metadata:
+        chunks.append(metadata[f"items_{len(chunks)}"])
+    lines = []
+    for line in "".join(chunks).split(";"):
+        if line:
+            product_id, quantity, price = line.split(":")
+            lines.append(OrderLine(int(product_id), int(quantity), Decimal(price)))
+    return int(metadata["cart_id"]), int(metadata["client_id"]), lines
+
+
+def finalize_order(session, payment_reference, cart_id, client_id, lines):
+    """ Records a paid order exactly once per payment_reference: reserves the stock, writes the sell
+    transaction and its items in bulk and removes the paid lines from the cart, all in one commit.
+    Returns "recorded", "duplicate" for a payment seen before, or "short" when stock ran out between
+    checkout and payment; short orders are stored voided and untouched in stock so staff can refund them. """
+    if session.scalar(select(Transaction.transaction_id).where(Transaction.payment_reference == payment_reference)):
+        return "duplicate"
+
+    status = "recorded"
+    try:
+        reserve_stock(session, order_quantities(lines))
+    except OutOfStock:
+        session.rollback()
+        status = "short"
+
+    transaction = Transaction(
+        client_id=client_id,
+        transaction_type="sell",  # from the store point of view
+        total_amount=sum(line.quantity * line.price for line in lines),
+        transaction_date=datetime.utcnow(),
+        is_voided=status == "short",
+        payment_reference=payment_reference,
+    )
+    session.add(transaction)
+    try:
+        session.flush()
+        session.execute(insert(TransactionItem), [
+            {"transaction_id": transaction.transaction_id, "product_id": line.product_id, "quantity": line.quantity, "price": line.price}
+            for line in lines
+        ])
+        if status == "recorded":
+            paid = [line.product_id for line in lines]
+            session.execute(delete(CartItem).where(CartItem.cart_id == cart_id, CartItem.product_id.in_(paid)))
+            # cached copies of the cart in other worker processes must reload rather than write the paid lines back
+            session.execute(update(UserCart).where(UserCart.cart_id == cart_id).values(version=UserCart.version + 1))
+            changes.touch(session, CartItem, [(cart_id, product_id) for product_id in paid])
+        session.commit()
+    except IntegrityError:
+        # a concurrent delivery of the same event committed first
+        session.rollback()
+        return "duplicate"
+    return status
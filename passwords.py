@@ -0,0 +1,116 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+
+# Hash parameters for new and upgraded passwords. Stored hashes made with other parameters
+# (e.g. the original 8 character salts) are rehashed the next time their owner logs in.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", f"pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}")
+PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH", 16))
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 1))  # 0 hashes on the request thread
+PASSWORD_MAX_PENDING = int(os.environ.get("PASSWORD_MAX_PENDING", 4 * max(PASSWORD_WORKERS, 1)))
+
+
+class HasherBusy(Exception):
+    """ Raised when more hashes are queued than PASSWORD_MAX_PENDING, so the caller can shed the request. """
+
+
+def _hash(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD, salt_length=PASSWORD_SALT_LENGTH)
+
+
+def _verify(stored_hash, password):
+    """ Returns (matches, upgraded_hash); upgraded_hash is None unless the stored parameters are outdated. """
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    return True, _hash(password) if needs_rehash(stored_hash) else None
+
+
+def needs_rehash(stored_hash):
+    """ True when stored_hash ("method$salt$hash") was made with other parameters than the configured ones. """
+    method, _, rest = stored_hash.partition("$")
+    salt = rest.partition("$")[0]
+    return method != PASSWORD_HASH_METHOD or len(salt) != PASSWORD_SALT_LENGTH
+
+
+# Runs the deliberately slow key derivations in worker processes, so they use every core instead of
+# holding the GIL of the web process. The request thread only waits on the result. The number of
+# hashes queued or running is capped; past the cap callers get HasherBusy instead of a growing backlog.
+class PasswordHasher:
+    def __init__(self, workers=PASSWORD_WORKERS, max_pending=PASSWORD_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._slots = BoundedSemaphore(max_pending)
+        self._lock = Lock()
+        self.completed = 0
+        self.rejected = 0
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy()
+        try:
+            return self._pool().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+            self.completed += 1
+
+    def hash(self, password):
+        """ Returns a new hash of password with the configured parameters. May raise HasherBusy. """
+        return self._run(_hash, password)
+
+    def verify(self, stored_hash, password):
+        """ Returns (matches, upgraded_hash) as described in _verify. May raise HasherBusy. """
+        return self._run(_verify, stored_hash, password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def stats(self):
+        return {"completed": self.completed, "rejected": self.rejected}
+
+
+def benchmark(stored_hash, password, seconds, concurrency, hasher=None):
+    """ Verifies password against stored_hash from concurrency threads for about seconds seconds.
+    Returns the verifications per second in total and per worker process (cpu core). """
+    hasher = hasher or password_hasher
+    deadline = time.monotonic() + seconds
+    counts = [0] * concurrency
+
+    def worker(index):
+        while time.monotonic() < deadline:
+            try:
+                hasher.verify(stored_hash, password)
+            except HasherBusy:
+                continue
+            counts[index] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        list(threads.map(worker, range(concurrency)))
+    elapsed = time.monotonic() - started
+    per_sec = sum(counts) / elapsed
+    return {
+        "verifications": sum(counts),
+        "seconds": round(elapsed, 2),
+        "per_sec": round(per_sec, 1),
+        "per_core": round(per_sec / max(hasher.workers, 1), 1),
+        "rejected": hasher.rejected,
+    }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,110 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+import stripe
+
+
+MAX_PENDING_CHECKOUTS = 1000
+PAID_CHECKOUT_EVENTS = ("checkout.session.completed", "checkout.session.async_payment_succeeded")
+ABANDONED_CHECKOUT_SECONDS = 600  # finished jobs nobody polled for this long are dropped
+
+
+def configure_stripe(api_key):
+    """ Points the stripe library at one shared, keep-alive connection pool with timeouts and bounded retries.
+    Retries reuse the same idempotency key, so a retried session creation never creates two sessions.
+    Settings come from the environment (.env):
+        STRIPE_API_BASE         e.g. http://127.0.0.1:12111 to use the local stripe_stub.py
+        STRIPE_CONNECT_TIMEOUT  seconds, default 3
+        STRIPE_READ_TIMEOUT     seconds, default 10
+        STRIPE_MAX_RETRIES      default 2
+        STRIPE_POOL_SIZE        keep-alive connections, default 10
+        STRIPE_WORKERS          checkout worker threads, default 0 (call Stripe on the request thread)
+        STRIPE_WEBHOOK_SECRET   signing secret of the payment webhook endpoint """
+    stripe.api_key = api_key
+    if os.environ.get("STRIPE_API_BASE"):
+        stripe.api_base = os.environ["STRIPE_API_BASE"]
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(os.environ.get("STRIPE_POOL_SIZE", 10)))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    stripe.default_http_client = stripe.RequestsClient(
+        timeout=(float(os.environ.get("STRIPE_CONNECT_TIMEOUT", 3)), float(os.environ.get("STRIPE_READ_TIMEOUT", 10))),
+        session=session,
+    )
+    stripe.max_network_retries = int(os.environ.get("STRIPE_MAX_RETRIES", 2))
+    checkout_jobs.start(int(os.environ.get("STRIPE_WORKERS", 0)))
+
+
+def create_checkout_session(line_items, success_url, cancel_url, **kwargs):
+    return stripe.checkout.Session.create(
+        line_items=line_items,
+        mode='payment',
+        success_url=success_url,
+        cancel_url=cancel_url,
+        **kwargs,
+    )
+
+
+def parse_webhook(payload, signature):
+    """ Verifies a Stripe webhook signature with STRIPE_WEBHOOK_SECRET and returns the event.
+    Raises ValueError for unsigned, tampered or malformed events. """
+    secret = os.environ.get("STRIPE_WEBHOOK_SECRET")
+    if not secret:
+        raise ValueError("STRIPE_WEBHOOK_SECRET is not configured")
+    try:
+        return stripe.Webhook.construct_event(payload, signature or "", secret)
+    except stripe.error.SignatureVerificationError as e:
+        raise ValueError(str(e))
+
+
+# Runs checkout jobs on a small thread pool so slow Stripe responses don't hold request threads.
+# Jobs are kept in process memory until the owner collects them, so a multi-worker deployment
+# needs sticky sessions for the status polling to land on the same worker.
+class CheckoutJobs:
+    def __init__(self):
+        self._executor = None
+        self._jobs = {}
+        self._lock = Lock()
+
+    def start(self, workers):
+        if workers and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stripe")
+
+    @property
+    def enabled(self):
+        return self._executor is not None
+
+    def submit(self, owner_id, fn, *args, **kwargs):
+        """ Starts fn in the pool and returns a job id, or None when too many checkouts are pending. """
+        with self._lock:
+            if len(self._jobs) >= MAX_PENDING_CHECKOUTS:
+                self._drop_abandoned()
+            if len(self._jobs) >= MAX_PENDING_CHECKOUTS:
+                return None
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = (owner_id, self._executor.submit(fn, *args, **kwargs), time.monotonic())
+        return job_id
+
+    def _drop_abandoned(self):
+        cutoff = time.monotonic() - ABANDONED_CHECKOUT_SECONDS
+        for job_id, (owner, future, started) in list(self._jobs.items()):
+            if future.done() and started < cutoff:
+                del self._jobs[job_id]
+
+    def result(self, owner_id, job_id):
+        """ Returns (done, result). Raises KeyError for unknown jobs and the job's exception if it failed. """
+        with self._lock:
+            owner, future, started = self._jobs.get(job_id, (None, None, None))
+            if future is None or owner != owner_id:
+                raise KeyError(job_id)
+            if not future.done():
+                return False, None
+            del self._jobs[job_id]
+        return True, future.result()
+
+
+checkout_jobs = CheckoutJobs()
@@ -0,0 +1,105 @@
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple
+from flask import g, request
+
+
+# Opt-in sampling profiler. A profiled request gets a helper thread that snapshots the request
+# thread's stack every PROFILE_INTERVAL_MS; the samples are saved in the folded format read by
+# flamegraph.pl, speedscope and similar tools. Requests that are not profiled pay only for the
+# two checks in start_profile.
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))  # fraction of all requests, 0 disables
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))  # newest profiles kept, older ones are deleted
+
+ProfileFile = namedtuple("ProfileFile", ["name", "created", "endpoint", "milliseconds", "samples"])
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self.started
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        """ One "root;...;leaf count" line per distinct stack. """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, keep=PROFILE_KEEP):
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.directory = None
+
+    def init_app(self, app, allowed):
+        """ Profiles requests carrying ?profile=1 when allowed() is true, and a random sample_rate fraction
+        of all requests. Profiles go to <instance>/profiles. """
+        self.directory = os.path.join(app.instance_path, "profiles")
+        os.makedirs(self.directory, exist_ok=True)
+
+        @app.before_request
+        def start_profile():
+            if (self.sample_rate and random.random() < self.sample_rate) or ("profile" in request.args and allowed()):
+                g.profile = Sampler(threading.get_ident())
+                g.profile.start()
+
+        @app.teardown_request
+        def save_profile(exc):
+            sampler = g.pop("profile", None)
+            if sampler is not None:
+                sampler.stop()
+                endpoint = request.url_rule.endpoint if request.url_rule else "unmatched"
+                self.save(sampler, endpoint)
+
+    def save(self, sampler, endpoint):
+        name = (f"{time.strftime('%Y%m%d-%H%M%S')}_{endpoint}_{round(sampler.seconds * 1000)}ms_"
+                f"{sum(sampler.stacks.values())}samples_{uuid.uuid4().hex[:6]}.folded")
+        with open(os.path.join(self.directory, name), "w") as file:
+            file.write(sampler.folded())
+        for old in self.recent()[self.keep:]:
+            os.remove(os.path.join(self.directory, old.name))
+        return name
+
+    def recent(self):
+        """ Returns the saved profiles as ProfileFiles, newest first. """
+        profiles = []
+        files = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+        for name in (entry.name for entry in files):
+            if name.endswith(".folded"):
+                parts = name[:-len(".folded")].split("_")  # endpoints may contain underscores themselves
+                profiles.append(ProfileFile(name, parts[0], "_".join(parts[1:-3]), parts[-3][:-2], parts[-2][:-7]))
+        return profiles
+
+
+profiler = Profiler()
@@ -0,0 +1,130 @@
+import re
+from contextlib import contextmanager
+from decimal import Decimal
+from sqlalchemy import event, select, update, bindparam, tuple_
+from sqlalchemy.orm import Session
+from database import Product, Inventory, Client, UserCart, CartItem, Transaction, TransactionItem
+import catalog
+import carts
+import facets
+import lookups
+import orders
+import users
+
+
+# Whole-table reads that are full scans by design: the department registry loads every department once.
+ALLOWED_SCANS = {"departments"}
+
+
+@contextmanager
+def _captured(connection, label, found):
+    """ Records every statement connection executes inside the block as (label, sql, parameters). """
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(("EXPLAIN", "SAVEPOINT", "RELEASE", "ROLLBACK", "BEGIN")):
+            found.append((label, statement, parameters))
+    event.listen(connection, "before_cursor_execute", record)
+    try:
+        yield
+    finally:
+        event.remove(connection, "before_cursor_execute", record)
+
+
+@contextmanager
+def _savepoint_session(connection):
+    """ A session on connection whose commits and rollbacks only release or roll back savepoints, so code
+    that commits can run inside the transaction hot_path_statements rolls back at the end. """
+    if not connection.connection.driver_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN")  # pysqlite defers BEGIN, and releasing an outermost SAVEPOINT would commit
+    session = Session(bind=connection, join_transaction_mode="create_savepoint")
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def _sample_ids(session):
+    """ Existing ids to fill in the hot path queries; the plans don't depend on them, so 0 works too. """
+    return {
+        "department_id": session.scalar(select(Product.department_id).limit(1)) or 0,
+        "product_id": session.scalar(select(Product.product_id).limit(1)) or 0,
+        "user_id": session.scalar(select(Client.user_id).limit(1)) or 0,
+        "cart_id": session.scalar(select(UserCart.cart_id).limit(1)) or 0,
+        "client_id": session.scalar(select(Client.client_id).limit(1)) or 0,
+        "transaction_id": session.scalar(select(Transaction.transaction_id).limit(1)) or 0,
+    }
+
+
+def hot_path_statements(session):
+    """ Returns (label, sql, parameters) for the statements issued by department_page, the login user
+    loader, the cart routes, the checkout webhook and update_inventory. Read paths run for real against
+    fresh cache instances; writes run inside a transaction that is rolled back. """
+    ids = _sample_ids(session)
+    session.rollback()
+    connection = session.connection()
+    found = []
+
+    with _captured(connection, "department_page: departments", found):
+        catalog.DepartmentRegistry().all()
+    read_model = catalog.CatalogReadModel()
+    with _captured(connection, "department_page: in-stock catalog", found):
+        read_model.products(ids["department_id"])
+    read_model.mark_stale([ids["product_id"]])
+    with _captured(connection, "department_page: catalog refresh", found):
+        read_model.products(ids["department_id"])
+    with _captured(connection, "department_page: facet counts", found):
+        facets.FacetCounts().groups(ids["department_id"])
+    with _captured(connection, "department_page: filtered products", found):
+        for filters in (facets.Filters(("brand",), (), (), "price"), facets.Filters((), ("family",), ("100-250",), "newest"),
+                        facets.Filters((), (), ("0-100", "1000-"), "-price")):
+            facets.products(ids["department_id"], filters)
+    with _captured(connection, "admin form autocomplete", found):
+        for lookup in lookups.LOOKUPS.values():
+            lookup.suggest("12")
+            lookup.label_of(0)
+    with _captured(connection, "load_user", found):
+        users.UserCache().get(ids["user_id"])
+    with _captured(connection, "view_cart: load cart", found):
+        carts.load_cart(ids["user_id"])
+
+    table = CartItem.__table__
+    match = (table.c.cart_id == bindparam("b_cart_id")) & (table.c.product_id == bindparam("b_product_id"))
+    with _captured(connection, "cart flush", found):
+        session.execute(
+            update(UserCart).where(UserCart.cart_id.in_([ids["cart_id"], 0]),
+                                   tuple_(UserCart.cart_id, UserCart.version).in_([(ids["cart_id"], 0), (0, 0)]))
+            .values(version=UserCart.version + 1).execution_options(synchronize_session=False)
+        )
+        params = {"b_cart_id": ids["cart_id"], "b_product_id": ids["product_id"]}
+        connection.execute(table.update().where(match).values(quantity=bindparam("b_quantity")), [dict(params, b_quantity=1)])
+        connection.execute(table.delete().where(match), [params])
+    with _captured(connection, "stripe_webhook: finalize_order", found), _savepoint_session(connection) as webhook_session:
+        # the real order code, reserving 0 units so the stock check passes whatever is in stock
+        orders.finalize_order(webhook_session, "plan-check", ids["cart_id"], ids["client_id"],
+                              [orders.OrderLine(ids["product_id"], 0, Decimal("0"))])
+    with _captured(connection, "update_inventory", found):
+        session.execute(select(TransactionItem).filter_by(transaction_id=ids["transaction_id"])).all()
+        session.execute(select(Inventory).filter_by(product_id=ids["product_id"])).all()
+    with _captured(connection, "transactions by client", found):
+        session.execute(
+            select(Transaction).where(Transaction.client_id == ids["client_id"]).order_by(Transaction.transaction_date.desc()).limit(20)
+        ).all()
+    session.rollback()
+    return found
+
+
+def full_scans(session):
+    """ Runs EXPLAIN QUERY PLAN (SQLite) on every hot path statement. Returns the plan steps that
+    scan a whole table, as (label, sql, detail), skipping the tables in ALLOWED_SCANS. """
+    scans = []
+    for label, sql, parameters in hot_path_statements(session):
+        if isinstance(parameters, list):  # executemany: one row of parameters is enough for the plan
+            parameters = parameters[0]
+        for row in session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", parameters):
+            detail = row[-1]
+            # joined eager loads alias their tables (clients_1), so compare the table name without the suffix;
+            # "SCAN CONSTANT ROW" walks a VALUES list, not a table
+            if detail.startswith("SCAN ") and "CONSTANT ROW" not in detail \
+                    and re.sub(r"_\d+$", "", detail.split()[1]) not in ALLOWED_SCANS:
+                scans.append((label, sql, detail))
+    session.rollback()
+    return scans
@@ -0,0 +1,523 @@
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+from datetime import datetime
+from threading import Lock
+from sqlalchemy import select, text, bindparam, or_
+from database import Product, Inventory
+from catalog import ProductCard
+from cache import changes
+
+
+# Full-text index of products.description, brand and product_family in an FTS5 table that reads its
+# text from products (external content). Triggers keep it in step with every insert, update and
+# delete, including the importer's bulk statements that bypass the ORM. Servers other than SQLite
+# fall back to a LIKE search.
+#
+# Results are ordered by bm25 with FTS5's column weights. bm25() in SQL scores every matching row and
+# first counts every row holding each phrase, a few milliseconds per ten thousand rows, so it only
+# runs for queries whose phrases hold at most SEARCH_EXACT_MATCHES rows altogether. The others are
+# scored here with the same formula from products_fts_weights, each term's frequency and column
+# length in each product. When FTS5 finds at most SEARCH_MATCHES products holding the query's two
+# rarest phrases, all of them are scored; otherwise the candidates are the products scoring best on
+# each term, one index range each whatever their age, half of SEARCH_CANDIDATES going to the rarest
+# phrase. A product that scores low on every term but high on their sum can be missed there;
+# "python benchmarks.py search" reports the recall against bm25() in SQL next to the latency.
+FTS_TABLE = "products_fts"
+FTS_VOCABULARY = "products_fts_vocab"
+FTS_WEIGHTS = "products_fts_weights"
+COLUMN_WEIGHTS = (10.0, 4.0, 2.0)  # description matches count most, then brand, then family
+BM25_K1, BM25_B = 1.2, 0.75  # FTS5's constants
+MAX_TERMS = 8
+PREFIX_EXPANSIONS = 16  # most frequent completions of the word being typed that are searched for
+SEARCH_CANDIDATES = int(os.environ.get("SEARCH_CANDIDATES", 1000))  # best products of the rarest phrase scored per query
+SEARCH_MATCHES = int(os.environ.get("SEARCH_MATCHES", 3000))  # most products of two phrases scored in full
+SEARCH_DEEPER = 4  # how much further a second read goes when the first found fewer than limit matches
+SEARCH_EXACT_MATCHES = int(os.environ.get("SEARCH_EXACT_MATCHES", 2000))  # most phrase rows ranked by bm25() in SQL
+TERM_CACHE_SIZE = 20000  # term counts and prefix completions kept per process
+
+FTS_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        description, brand, product_family,
+        content='products', content_rowid='product_id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"CREATE VIRTUAL TABLE {FTS_VOCABULARY} USING fts5vocab({FTS_TABLE}, row)",
+    f"""CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON products BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, description, brand, product_family)
+        VALUES (new.product_id, new.description, new.brand, new.product_family);
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON products BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description, brand, product_family)
+        VALUES ('delete', old.product_id, old.description, old.brand, old.product_family);
+        DELETE FROM {FTS_WEIGHTS} WHERE product_id = old.product_id;
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF description, brand, product_family ON products BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description, brand, product_family)
+        VALUES ('delete', old.product_id, old.description, old.brand, old.product_family);
+        INSERT INTO {FTS_TABLE}(rowid, description, brand, product_family)
+        VALUES (new.product_id, new.description, new.brand, new.product_family);
+    END""",
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+    f"""CREATE TABLE {FTS_WEIGHTS} (
+        term TEXT NOT NULL, product_id INTEGER NOT NULL,
+        weight REAL NOT NULL, frequency REAL NOT NULL, length INTEGER NOT NULL
+    )""",
+    f"CREATE INDEX {FTS_WEIGHTS}_term ON {FTS_WEIGHTS} (term, weight DESC, product_id DESC, frequency, length)",
+    f"CREATE INDEX {FTS_WEIGHTS}_product ON {FTS_WEIGHTS} (product_id, term, frequency, length)",
+]
+FTS_DROP = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_update",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_insert",
+    f"DROP TABLE IF EXISTS {FTS_WEIGHTS}",
+    f"DROP TABLE IF EXISTS {FTS_VOCABULARY}",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+_RANKED = text(f"""
+    SELECT p.product_id, p.department_id, p.description, p.brand, p.price, p.image_url, i.quantity
+    FROM {FTS_TABLE} AS f
+    JOIN products AS p ON p.product_id = f.rowid
+    JOIN inventory AS i ON i.product_id = f.rowid
+    WHERE {FTS_TABLE} MATCH :query AND i.quantity > 0
+    ORDER BY bm25({FTS_TABLE}, {', '.join(map(str, COLUMN_WEIGHTS))}), f.rowid DESC
+    LIMIT :limit
+""")
+_MATCHES = text(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query LIMIT :most")
+_WORD = re.compile(r"\w+")
+_TERM = text(f"SELECT doc FROM {FTS_VOCABULARY} WHERE term = :term")
+_COMPLETIONS = text(f"""
+    SELECT term, doc FROM {FTS_VOCABULARY} WHERE term >= :prefix AND term < :after ORDER BY doc DESC LIMIT :expansions
+""")
+_AVERAGES = text(f"SELECT block FROM {FTS_TABLE}_data WHERE id = 1")  # FTS5's row count and tokens per column
+_WRITE_WEIGHTS = text(f"""
+    INSERT INTO {FTS_WEIGHTS} (term, product_id, weight, frequency, length)
+    VALUES (:term, :product_id, :weight, :frequency, :length)
+""")
+_DELETE_WEIGHTS = text(f"DELETE FROM {FTS_WEIGHTS} WHERE product_id IN :product_ids").bindparams(
+    bindparam("product_ids", expanding=True))
+WEIGHTS_BATCH = 10000
+
+
+def ensure_index(connection):
+    """ Creates and fills the FTS5 tables, the term weights and the triggers when any of them is missing, e.g.
+    on a new database or after a batch migration rebuilt products without its triggers (SQLite only). """
+    if connection.dialect.name != "sqlite":
+        return False
+    names = {FTS_TABLE, FTS_VOCABULARY, FTS_WEIGHTS, f"{FTS_TABLE}_insert", f"{FTS_TABLE}_delete", f"{FTS_TABLE}_update"}
+    present = connection.exec_driver_sql(
+        f"SELECT name FROM sqlite_master WHERE name IN ({', '.join('?' * len(names))})", tuple(names)
+    ).scalars().all()
+    if len(present) == len(names):
+        return False
+    for statement in FTS_DROP + FTS_SCHEMA:
+        connection.exec_driver_sql(statement)
+    write_weights(connection)
+    return True
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """ Keeps Alembic autogenerate from dropping the FTS5 tables and their shadow tables. """
+    return not (type_ == "table" and name.startswith(FTS_TABLE))
+
+
+def tokens(value):
+    """ Splits text the way the index's unicode61 tokenizer does: lowercase, without diacritics. """
+    value = (value or "").lower()
+    if not value.isascii():
+        value = "".join(char for char in unicodedata.normalize("NFKD", value) if not unicodedata.combining(char))
+    return _WORD.findall(value)
+
+
+def averages(connection):
+    """ Returns FTS5's (indexed rows, average tokens per row), read from the record bm25() uses. """
+    block = connection.execute(_AVERAGES).scalar()
+    values, position = [], 0
+    while block and position < len(block):  # SQLite varints: 7 bits a byte, high bit set on all but the last
+        value = 0
+        for index in range(9):
+            byte = block[position]
+            position += 1
+            if index == 8:
+                value = (value << 8) | byte
+                break
+            value = (value << 7) | (byte & 0x7f)
+            if byte < 0x80:
+                break
+        values.append(value)
+    if not values or not values[0]:
+        return 0, 1.0
+    return values[0], sum(values[1:]) / values[0] or 1.0
+
+
+def frequencies(columns):
+    """ Counts the terms of one product's (description, brand, product_family), each occurrence weighted by
+    its column, and returns them with the product's length in tokens. """
+    weighted, length = {}, 0
+    for column_weight, value in zip(COLUMN_WEIGHTS, columns):
+        column = tokens(value)
+        length += len(column)
+        for token in column:
+            weighted[token] = weighted.get(token, 0.0) + column_weight
+    return weighted, length
+
+
+def write_weights(connection, product_ids=None):
+    """ Rewrites the products_fts_weights rows of product_ids, or of every product, from the current text.
+    weight is the term's bm25 score in the product, without the idf, at the average length of the moment;
+    it only orders the candidates, which are scored afresh from frequency and length. """
+    _, average = averages(connection)
+    query = select(Product.product_id, Product.description, Product.brand, Product.product_family)
+    chunks = [None] if product_ids is None else [product_ids[n:n + 1000] for n in range(0, len(product_ids), 1000)]
+    for chunk in chunks:
+        if chunk is not None:
+            connection.execute(_DELETE_WEIGHTS, {"product_ids": chunk})
+        batch = []
+        for product_id, *columns in connection.execute(query if chunk is None else query.where(Product.product_id.in_(chunk))):
+            weighted, length = frequencies(columns)
+            normaliser = BM25_K1 * (1 - BM25_B + BM25_B * length / average)
+            batch.extend({
+                "term": term, "product_id": product_id, "length": length, "frequency": frequency,
+                "weight": frequency * (BM25_K1 + 1) / (frequency + normaliser),
+            } for term, frequency in weighted.items())
+            if len(batch) >= WEIGHTS_BATCH:
+                connection.execute(_WRITE_WEIGHTS, batch)
+                batch = []
+        if batch:
+            connection.execute(_WRITE_WEIGHTS, batch)
+
+
+def _update_weights(session, keys):
+    product_ids = sorted(key for key in keys if key is not None)
+    if product_ids and session.get_bind().dialect.name == "sqlite":
+        write_weights(session.connection(), product_ids)
+
+
+# written inside the committing transaction, like the FTS5 rows the triggers write
+changes.subscribe([Product], _update_weights, key=lambda product: product.product_id, before_commit=True)
+
+
+# Number of products holding each term, and the completions of typed prefixes, read from the
+# fts5vocab table on first use, plus the row count and average length bm25 needs. Both are least recently used caches of TERM_CACHE_SIZE entries that
+# keep only what the index holds, so random queries can't fill them; both are dropped whenever a
+# Product row is committed.
+class TermStats:
+    def __init__(self, max_size=TERM_CACHE_SIZE):
+        self.max_size = max_size
+        self._documents = OrderedDict()  # term -> products holding it
+        self._completions = OrderedDict()  # prefix -> [terms]
+        self._averages = None
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, entries, key):
+        with self._lock:
+            value = entries.get(key)
+            if value is not None:
+                entries.move_to_end(key)
+            return value
+
+    def _put(self, entries, key, value):
+        with self._lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def averages(self, session):
+        """ Returns (indexed rows, average tokens per row), see averages(). """
+        if self._averages is None:
+            self._averages = averages(session)
+        return self._averages
+
+    def documents(self, session, term):
+        count = self._get(self._documents, term)
+        if count is not None:
+            self.hits += 1
+            return count
+        self.misses += 1
+        count = session.execute(_TERM, {"term": term}).scalar() or 0
+        if count:
+            self._put(self._documents, term, count)
+        return count
+
+    def completions(self, session, prefix):
+        """ Returns the PREFIX_EXPANSIONS most common indexed terms starting with prefix. """
+        terms = self._get(self._completions, prefix)
+        if terms is not None:
+            self.hits += 1
+            return terms
+        self.misses += 1
+        rows = session.execute(_COMPLETIONS, {
+            "prefix": prefix, "after": prefix + "\U0010ffff", "expansions": PREFIX_EXPANSIONS,
+        }).all()
+        terms = [term for term, count in rows]
+        if terms:
+            for term, count in rows:
+                self._put(self._documents, term, count)
+            self._put(self._completions, prefix, terms)
+        return terms
+
+    def invalidate(self, keys=None):
+        with self._lock:
+            self._documents, self._completions, self._averages = OrderedDict(), OrderedDict(), None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "terms": len(self._documents)}
+
+
+term_stats = TermStats()
+changes.subscribe([Product], term_stats.invalidate)
+
+
+def _quote(term):
+    return f'"{term}"'
+
+
+def search(session, query, limit=20):
+    """ Returns up to limit in-stock ProductCards matching every word of query, best bm25 score
+    first (see the note at the top for queries of common words). The last word is matched as a
+    prefix, so typeahead finds "strat" in "Stratocaster". """
+    words = tokens(query)[:MAX_TERMS]
+    if not words:
+        return []
+    if session.get_bind().dialect.name != "sqlite":
+        return _search_like(session, words, limit)
+    phrases = _phrases(session, words)
+    return rank(session, phrases, limit)[0] if phrases else []
+
+
+def _phrases(session, words):
+    # each phrase is the set of indexed terms it accepts: one whole word, or the completions of the last
+    phrases = [[word] for word in words[:-1]] + [term_stats.completions(session, words[-1])]
+    return phrases if phrases[-1] else []
+
+
+def _expression(phrases):
+    return " AND ".join(
+        "(" + " OR ".join(_quote(term) for term in phrase) + ")" if len(phrase) > 1 else _quote(phrase[0])
+        for phrase in phrases
+    )
+
+
+def _holding(session, phrase):
+    return sum(term_stats.documents(session, term) for term in phrase)
+
+
+def exact_ranking(session, phrases):
+    """ True when bm25() in SQL is cheap for the query: its phrases hold few rows altogether. """
+    return sum(_holding(session, phrase) for phrase in phrases) <= SEARCH_EXACT_MATCHES
+
+
+def rank(session, phrases, limit):
+    """ Returns (cards, how) for a parsed query, how being "exact" for bm25() in SQL, "matches" when
+    every product holding the two rarest phrases was scored, "weights" for the candidates read from
+    products_fts_weights, or "deeper" when those held fewer than limit results and a second read took
+    SEARCH_DEEPER times as many. """
+    if exact_ranking(session, phrases):
+        return _ranked(session, phrases, limit), "exact"
+    total, average = term_stats.averages(session)
+    parameters = {"limit": limit, "k1": BM25_K1, "b": BM25_B, "average": average}
+    for index, phrase in enumerate(phrases):
+        for n, term in enumerate(phrase):
+            holding = min(total, term_stats.documents(session, term))
+            # every term of the expression is a phrase of its own to bm25(), with its own idf
+            parameters[f"idf_{index}_{n}"] = max(1e-6, math.log((total - holding + 0.5) / (holding + 0.5)))
+            parameters[f"term_{index}_{n}"] = term
+    sizes = tuple(map(len, phrases))
+    if len(phrases) > 1:
+        # FTS5 intersects the two rarest phrases quickly; when that leaves few products, all of them are scored
+        pair = sorted(phrases, key=lambda phrase: _holding(session, phrase))[:2]
+        matches = session.execute(_MATCHES, {"query": _expression(pair), "most": SEARCH_MATCHES + 1}).scalars().all()
+        if len(matches) <= SEARCH_MATCHES:
+            parameters["matches"] = json.dumps(matches)
+            return [ProductCard(*row) for row in session.execute(_weighted_query(sizes, True), parameters)], "matches"
+    query = _weighted_query(sizes)
+    depths = _depths(session, phrases, limit)
+    for how, factor in (("weights", 1), ("deeper", SEARCH_DEEPER)):
+        parameters.update({f"depth_{index}": depth * factor for index, depth in enumerate(depths)})
+        cards = [ProductCard(*row) for row in session.execute(query, parameters)]
+        if len(cards) == limit or all(_holding(session, phrase) <= depth * factor for phrase, depth in zip(phrases, depths)):
+            break
+    return cards, how
+
+
+def _depths(session, phrases, limit):
+    """ How many products to read per term of each phrase. A single term is read in (nearly) score order,
+    so a few more than limit are enough; other queries read deepest into the rarest phrase, which every
+    match holds: half of SEARCH_CANDIDATES, the other phrases sharing the rest. """
+    if len(phrases) == len(phrases[0]) == 1:
+        return [4 * limit]
+    if len(phrases) == 1:
+        return [max(limit, SEARCH_CANDIDATES // len(phrases[0]))]
+    holding = [_holding(session, phrase) for phrase in phrases]
+    rarest = holding.index(min(holding))
+    shares = [2 if index == rarest else 2 * (len(phrases) - 1) for index in range(len(phrases))]
+    return [max(limit, SEARCH_CANDIDATES // share // len(phrase)) for phrase, share in zip(phrases, shares)]
+
+
+def _ranked(session, phrases, limit):
+    return [ProductCard(*row) for row in session.execute(_RANKED, {"query": _expression(phrases), "limit": limit})]
+
+
+@lru_cache(maxsize=256)
+def _weighted_query(sizes, matched=False):
+    """ bm25 over products_fts_weights for phrases of sizes terms. The candidates are the :depth_<phrase>
+    products scoring best on each term (one index range each), or the in-stock :matches when matched, kept
+    when they hold every phrase and are in stock. A single term is scored from its index range alone. """
+    phrases = range(len(sizes))
+    terms = [[f":term_{index}_{n}" for n in range(sizes[index])] for index in phrases]
+    ranges = {
+        index: " UNION ALL ".join(
+            f"SELECT * FROM (SELECT product_id, term, frequency, length FROM {FTS_WEIGHTS} WHERE term = {term} "
+            f"ORDER BY weight DESC, product_id DESC LIMIT :depth_{index})"
+            for term in terms[index]
+        )
+        for index in phrases
+    }
+    if sizes == (1,) and not matched:
+        rows = ranges[0]
+    else:
+        if matched:
+            candidates = f"""
+                SELECT m.value AS product_id FROM json_each(:matches) AS m
+                CROSS JOIN inventory AS i ON i.product_id = m.value
+                WHERE i.quantity > 0
+            """
+        else:
+            candidates = " UNION ".join(f"SELECT product_id FROM ({ranges[index]})" for index in phrases)
+        # CROSS JOIN keeps SQLite from walking a common term's index range instead of looking products up
+        rows = f"""
+            SELECT w.product_id, w.term, w.frequency, w.length
+            FROM ({candidates}) AS c
+            CROSS JOIN {FTS_WEIGHTS} AS w ON w.product_id = c.product_id
+            WHERE w.term IN ({", ".join(term for index in phrases for term in terms[index])})
+        """
+    saturated = "frequency * (:k1 + 1) / (frequency + :k1 * (1 - :b + :b * length / :average))"
+    idf = " ".join(f"WHEN {term} THEN :idf_{index}_{n}" for index in phrases for n, term in enumerate(terms[index]))
+    held = " AND ".join(f"max(term IN ({', '.join(terms[index])}))" for index in phrases)
+    return text(f"""
+        SELECT p.product_id, p.department_id, p.description, p.brand, p.price, p.image_url, top.quantity
+        FROM (
+            SELECT ranked.product_id, ranked.score, i.quantity FROM (
+                SELECT product_id, sum(CASE term {idf} END * {saturated}) AS score
+                FROM ({rows})
+                GROUP BY product_id
+                HAVING {held}
+            ) AS ranked
+            JOIN inventory AS i ON i.product_id = ranked.product_id
+            WHERE i.quantity > 0
+            ORDER BY ranked.score DESC, ranked.product_id DESC
+            LIMIT :limit
+        ) AS top
+        JOIN products AS p ON p.product_id = top.product_id
+        ORDER BY top.score DESC, top.product_id DESC
+    """)
+
+
+def _search_like(session, words, limit):
+    conditions = [
+        or_(Product.description.ilike(f"%{word}%"), Product.brand.ilike(f"%{word}%"), Product.product_family.ilike(f"%{word}%"))
+        for word in words
+    ]
+    rows = session.execute(
+        select(Product.product_id, Product.department_id, Product.description, Product.brand,
+               Product.price, Product.image_url, Inventory.quantity)
+        .join(Inventory, Inventory.product_id == Product.product_id)
+        .where(Inventory.quantity > 0, *conditions)
+        .order_by(Product.product_id.desc())
+        .limit(limit)
+    ).all()
+    return [ProductCard(*row) for row in rows]
+
+
+BENCH_BRANDS = ["Fender", "Gibson", "Ibanez", "Yamaha", "Roland", "Ludwig", "Pearl", "Tama", "Casio", "Korg",
+                "Schecter", "Epiphone", "Gretsch", "Squier", "Jackson", "PRS", "Martin", "Taylor", "Zildjian", "Sabian"]
+BENCH_KINDS = ["Stratocaster Electric Guitar", "Telecaster Electric Guitar", "Les Paul Guitar", "Acoustic Guitar",
+               "Bass Guitar", "5-Piece Drum Set", "Snare Drum", "Cymbal Pack", "Stage Piano", "Digital Piano",
+               "Synthesizer", "Keyboard Amplifier", "Guitar Amplifier", "Bass Amplifier", "Effects Pedal",
+               "Drum Throne", "Hi-Hat Stand", "Guitar Strings", "Drum Sticks", "MIDI Controller"]
+BENCH_COLORS = ["Black", "Sunburst", "Cherry", "Aqua Marine", "Charcoal Burst", "Coral Blue", "Redwood",
+                "Natural", "White", "Chrome", "Metallic Red", "Olympic White", "Walnut", "Silver Sparkle"]
+
+
+def benchmark(path, products, queries, limit=20, seed=7, recall_samples=50):
+    """ Builds a synthetic catalog of products rows in a fresh SQLite file at path, then times queries
+    searches (typeahead prefixes and whole words) through search(). Returns the latency percentiles in ms,
+    the share of queries taking each path of rank(), and the recall of the other paths against bm25() in
+    SQL (the share of its top-limit products found) over recall_samples of those queries. """
+    import random
+    import time
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.orm import Session
+    from database import db, Department
+
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine(f"sqlite:///{path}")
+    db.metadata.create_all(engine)
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        connection.execute(insert(Department), [{"department_id": n, "name": f"Department {n}"} for n in range(1, 6)])
+        for first in range(1, products + 1, 50000):
+            ids = range(first, min(first + 50000, products + 1))
+            connection.execute(insert(Product), [{
+                "product_id": n, "department_id": n % 5 + 1,
+                "description": f"{rng.choice(BENCH_BRANDS)} {rng.choice(BENCH_KINDS)} {rng.choice(BENCH_COLORS)} model {n}",
+                "brand": rng.choice(BENCH_BRANDS), "website_url": f"https://example.com/{n}", "image_url": "logo.png",
+                "price": rng.randint(10, 5000), "cost": 1, "product_family": rng.choice(BENCH_KINDS).split()[-1],
+                "stripe_product_code": "", "stripe_price_code": "",
+            } for n in ids])
+            connection.execute(insert(Inventory), [
+                {"product_id": n, "quantity": rng.choice([0, 0, 1, 3, 10]), "acquired_date": datetime.utcnow()} for n in ids
+            ])
+        ensure_index(connection)
+        connection.exec_driver_sql("ANALYZE")
+    build_seconds = time.perf_counter() - started
+
+    words = sorted({word for phrase in BENCH_BRANDS + BENCH_KINDS + BENCH_COLORS for word in re.findall(r"\w+", phrase.lower())})
+    samples = []
+    for _ in range(queries):
+        kind = rng.random()
+        if kind < 0.4:  # typeahead: the first letters of a word
+            query = rng.choice(words)[:rng.randint(2, 5)]
+        elif kind < 0.8:  # a brand and a kind, the last word still being typed
+            query = f"{rng.choice(BENCH_BRANDS)} {rng.choice(BENCH_KINDS).split()[0][:4]}"
+        else:
+            query = f"{rng.choice(BENCH_COLORS)} {rng.choice(BENCH_KINDS)}"
+        samples.append(query)
+
+    timings = []
+    term_stats.invalidate()
+    with Session(engine) as session:
+        search(session, "warm up", limit)
+        for query in samples:
+            started = time.perf_counter()
+            search(session, query, limit)
+            timings.append((time.perf_counter() - started) * 1000)
+        paths, recalls = {"exact": 0, "matches": 0, "weights": 0, "deeper": 0}, []
+        for query in samples:
+            phrases = _phrases(session, tokens(query)[:MAX_TERMS])
+            if not phrases:
+                paths["exact"] += 1
+                continue
+            cards, how = rank(session, phrases, limit)
+            paths[how] += 1
+            if how != "exact" and len(recalls) < recall_samples:
+                best = {card.product_id for card in _ranked(session, phrases, limit)}
+                recalls.append(len(best & {card.product_id for card in cards}) / len(best) if best else 1.0)
+    term_stats.invalidate()  # the counts belong to the synthetic catalog
+    engine.dispose()
+    timings.sort()
+    percentile = lambda p: round(timings[min(len(timings) - 1, int(len(timings) * p))], 2)
+    return {"products": products, "queries": queries, "build_seconds": round(build_seconds, 1),
+            "p50": percentile(0.50), "p95": percentile(0.95), "p99": percentile(0.99), "max": round(timings[-1], 2),
+            **{f"{how}_share": round(count / len(samples), 2) for how, count in paths.items()},
+            "recall": round(sum(recalls) / len(recalls), 2) if recalls else None}
@@ -1,22 +1,42 @@
 import os
 from dotenv import load_dotenv
-from flask import Flask, render_template, redirect, url_for, flash, request
+from flask import Flask, render_template, redirect, url_for, flash, request, abort, Response, stream_with_context, send_from_directory, send_file, session, jsonify
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
 from flask_login import login_user, login_required, LoginManager, current_user, logout_user
 from flask_migrate import Migrate
-from flask_wtf.csrf import CSRFProtect
+from flask_wtf.csrf import CSRFProtect, generate_csrf
+from markupsafe import Markup
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
 from forms import RegisterForm, LoginForm, DepartmentForm, ProductForm, EmployeeForm, TransactionForm, PaymentForm, ClientForm, AddressForm, InventoryForm
 from datetime import datetime
-from database import db, Product, Department, Inventory, BaseUser, Client, Address, Employee, Transaction, TransactionItem, Payment, UserCart, CartItem
+from database import db, Product, Department, Inventory, BaseUser, Client, Address, Employee, Transaction, TransactionItem, Payment, UserCart
 import re
-from sqlalchemy.event import listens_for
+import hashlib
+import time
+from werkzeug.http import is_resource_modified
 from sqlalchemy.inspection import inspect
-from sqlalchemy.orm import joinedload
 from sqlalchemy import select
-import stripe
+from sqlalchemy.exc import IntegrityError
+import catalog
+import admin
+import importer
+import orders
+import carts
+import payments
+import users
+import passwords
+import db_profiles
+import sql_stats
+import metrics
+import profiler
+import images
+import assets
+import fragments
+import search
+import facets
+import lookups
+import click
 
 
 # load virtual environment and initiate Flask
@@ -24,20 +44,36 @@ load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(app.instance_path, 'retail.db')}"
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+# sqlite file in WAL mode by default, or DATABASE_PROFILE=url with DATABASE_URL for a server database
+db_profiles.configure_database(app)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 YOUR_DOMAIN = "http://127.0.0.1:5000"
 
-# payment website key
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+# payment website key, shared keep-alive connection pool and optional checkout workers
+payments.configure_stripe(os.environ.get('STRIPE_SECRET_KEY'))
 
 # initiate database
 db.init_app(app)
+carts.cart_service.init_app(app)
+# content hashed static urls with year long caching, precompressed static files and compressed html
+assets.static_assets.init_app(app)
+# statement count and DB time per request in a Server-Timing header, N+1 warnings in debug mode
+sql_stats.init_app(app)
+# request counts, latency histograms, SQL per endpoint and cache hit counters for /metrics
+metrics.init_app(app, {"departments": catalog.departments, "carts": carts.cart_service, "users": users.user_cache,
+                       "fragments": fragments.fragment_cache, "search_terms": search.term_stats,
+                       "facets": facets.facet_counts})
+# refresh the catalog caches with the changes committed by the other worker processes
+app.before_request(catalog.sync.poll)
 with app.app_context():
     db.create_all()
+    # full-text product search index (SQLite only); existing databases get it from the migration too
+    with db.engine.begin() as connection:
+        search.ensure_index(connection)
 
 # load migration option and bootstrap form functionalities
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, include_object=search.include_object)
 ckeditor = CKEditor(app)
 Bootstrap5(app)
 
@@ -51,10 +87,8 @@ csrf = CSRFProtect(app)
 # configure user loader for Flask Login
 @login_manager.user_loader
 def load_user(user_id):
-    user = db.session.get(BaseUser, int(user_id))  # ✅ SQLAlchemy 2.0 Compatible
-    if user:
-        return user
-    return None
+    # the user and its client/employee profile come from a short lived cache, or from one joined query
+    return users.user_cache.get(int(user_id))
 
 
 # configure employee access decorator
@@ -70,6 +104,15 @@ def employee_required(f):
     return decorated_function
 
 
+def is_admin():
+    """ True for logged in employees with clearance code 99. """
+    return bool(current_user.is_authenticated and current_user.employee and current_user.employee.clearance_code == "99")
+
+
+# sampling profiler for ?profile=1 requests of admins and a PROFILE_SAMPLE_RATE fraction of all traffic
+profiler.profiler.init_app(app, allowed=is_admin)
+
+
 def get_primary_key(model):
     """Returns the primary key column name for a given SQLAlchemy model class."""
     return inspect(model).primary_key[0].name  # Get the first (and usually only) primary key
@@ -77,33 +120,176 @@ def get_primary_key(model):
 
 @app.context_processor
 def inject_departments():
-    departments = db.session.execute(db.select(Department)).scalars().all()
+    # departments are served from the process-local registry, which is reloaded after any Department commit
+    departments = catalog.departments.all()
     return {'departments': departments}  # departments will feed base.html and be available to all templates
 
 
+# resized WebP derivatives of the static product and banner images
+image_pipeline = images.ImagePipeline(app.static_folder, os.path.join(app.instance_path, "image_cache"))
+
+
+@app.template_global()
+def responsive_image(filename):
+    """ Returns the src and srcset for a static image; srcset is None when the original can't be resized. """
+    digest = image_pipeline.source_digest(filename) if images.ImagePipeline.can_resize(filename) else None
+    if digest is None:
+        return {"src": url_for('static', filename=filename), "srcset": None}
+    widths = image_pipeline.widths(filename)
+    urls = {size: url_for('derived_image', size=size, digest=digest, filename=filename) for size in widths}
+    return {
+        "src": urls.get("card", urls["thumbnail"]),
+        "srcset": ", ".join(f"{urls[size]} {width}w" for size, width in widths.items()),
+    }
+
+
+@app.template_global()
+def product_card(product, slot=""):
+    """ The product's card markup from the fragment cache, with slot (e.g. the add-to-cart form) filled in.
+    Cards are keyed by their ProductCard, so a changed price or stock level never serves old markup. """
+    card = fragments.fragment_cache.render(
+        ("card", product.product_id, product),
+        lambda: render_template("product_card.html", product=product, slot=Markup(fragments.SLOT)),
+    )
+    return fragments.fill_slot(card, slot)
+
+
+@app.template_global()
+def product_grid(department_id, products, variant=""):
+    """ The product list of a department (and filter state, variant) for visitors without a cart,
+    cached per catalog version. """
+    return fragments.fragment_cache.render(
+        ("grid", department_id, catalog.version.etag(), variant),
+        lambda: Markup("").join(product_card(product) for product in products),
+    )
+
+
+# serves an image derivative; the digest in the url changes with the original, so it is cached for a year
+@app.route("/images/<size>/<digest>/<path:filename>")
+def derived_image(size, digest, filename):
+    if size not in images.DERIVATIVE_WIDTHS:
+        abort(404)
+    current = image_pipeline.source_digest(filename)
+    if current is None:
+        abort(404)
+    if current != digest:
+        return redirect(url_for('derived_image', size=size, digest=current, filename=filename))
+    try:
+        path = image_pipeline.derivative_path(filename, size)
+    except ValueError:
+        return redirect(url_for('static', filename=filename))
+    response = send_file(path, mimetype="image/webp", max_age=31536000)
+    response.cache_control.immutable = True
+    return response
+
+
+CSRF_TOKEN_REUSE_SECONDS = 1800  # a client's cached page (and its csrf token) is re-rendered after this
+
+
+def catalog_validators(page):
+    """ Returns (etag, last_modified, private) of a catalog page for the current visitor, or None when
+    the page must be rendered anyway (pending flash messages). Anonymous visitors and employees share one
+    variant per role; a client's page carries add-to-cart forms with their session's csrf token, so each
+    client session gets its own validator, renewed before the token expires. """
+    if "_flashes" in session:
+        return None
+    if not current_user.is_authenticated:
+        variant = "anonymous"
+    elif current_user.client:
+        generate_csrf()  # makes sure the session token exists before it goes into the validator
+        token = hashlib.sha256(session["csrf_token"].encode()).hexdigest()[:12]
+        variant = f"client-{current_user.id}-{token}-{int(time.time() // CSRF_TOKEN_REUSE_SECONDS)}"
+    else:
+        variant = "employee" if current_user.employee else "user"
+    etag = f"{page}-{catalog.version.etag()}-{variant}-{datetime.now().year}"
+    return etag, catalog.version.last_modified(), current_user.is_authenticated
+
+
+def conditional_page(validators, render):
+    """ Answers 304 Not Modified when the browser's copy matches validators, otherwise calls render(). """
+    if validators is None:
+        return render()
+    etag, last_modified, private = validators
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = app.make_response(render())
+    response.set_etag(etag, weak=True)  # weak: the body may be sent compressed
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.cache_control.private = private
+    response.vary.add("Cookie")
+    return response
+
+
 # Home Route
 @app.route("/")
 def home():
-    return render_template("home.html", year=datetime.now().year)
-
+    return conditional_page(catalog_validators("home"), lambda: render_template("home.html", year=datetime.now().year))
 
-# Departments Route
-@app.route("/department/<department>")
-def department_page(department):
-    department_id = db.session.execute(db.select(Department).filter_by(name=department.title())).scalar_one_or_none().department_id
-    # Query only products that have inventory with quantity > 0
-    products = db.session.execute(
-        db.select(Product)
-        .join(Inventory)  # Join Product with Inventory
-        .filter(Product.department_id == department_id, Inventory.quantity > 0)
-        .options(joinedload(Product.inventory))
-    ).scalars().all()
 
-    # Extract inventory quantities (avoid extra queries)
-    inventory = [product.inventory.quantity for product in products]
+# Prometheus scrape target, for the METRICS_ALLOWED_IPS scrapers and admins
+@app.route("/metrics")
+def metrics_page():
+    if request.remote_addr not in metrics.ALLOWED_SCRAPERS and not is_admin():
+        abort(403)
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
-    return render_template("department.html", department=department, inventory=inventory, products=products)
 
+# Departments Route, with brand, product family and price range filters and sort orders in the query string
+@app.route("/department/<department>")
+def department_page(department):
+    department_entry = catalog.departments.get_by_name(department)
+    if department_entry is None:
+        abort(404)
+    department_id = department_entry.department_id
+    filters = facets.parse(request.args)
+    variant = facets.canonical(filters)
+
+    def render():
+        if filters == facets.NO_FILTERS:
+            # in-stock products (quantity > 0) come from the catalog read model, which is kept in sync with Inventory commits
+            products = catalog.in_stock.products(department_id)
+        else:
+            # filtered and sorted in the database, on the products (department_id, ...) indexes
+            products = facets.products(department_id, filters)
+        return render_template("department.html", department=department, department_id=department_id, products=products,
+                               facets=facets.facet_counts.facets(department_id, filters),
+                               sorts=facets.sort_options(filters), filtered=filters != facets.NO_FILTERS, variant=variant)
+
+    # repeat visits get 304 Not Modified without reading products or rendering; every filter state has its own validator
+    page = f"department-{department_id}" + (f"-{hashlib.sha256(variant.encode()).hexdigest()[:12]}" if variant else "")
+    return conditional_page(catalog_validators(page), render)
+
+
+SEARCH_RESULTS = 20  # products on the search page
+SUGGESTIONS = 8  # typeahead entries
+
+
+# Product search: in-stock products matching every word, best match first
+@app.route("/search")
+def search_page():
+    query = request.args.get("q", "")[:200]
+    products = search.search(db.session, query, limit=SEARCH_RESULTS)
+    department_names = {entry.department_id: entry.name for entry in catalog.departments.all()}
+    return render_template("search.html", query=query, products=products, department_names=department_names)
+
+
+# Typeahead suggestions for the navbar search box
+@app.route("/search/suggest")
+def search_suggest():
+    department_names = {entry.department_id: entry.name for entry in catalog.departments.all()}
+    products = search.search(db.session, request.args.get("q", "")[:200], limit=SUGGESTIONS)
+    response = jsonify([{
+        "product_id": product.product_id,
+        "description": product.description,
+        "url": url_for("department_page", department=department_names.get(product.department_id, "")),
+    } for product in products])
+    # the same for every visitor, so browsers and proxies may reuse it briefly while the user types
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
 
 # Register new clients and emplyees into the Client/Employee database
 @app.route('/register_user', methods=["GET", "POST"])
@@ -126,11 +312,8 @@ def register():
             flash("You've already registered with that email, log in instead!")
             return redirect(url_for('login'))
 
-        hash_and_salted_password = generate_password_hash(
-            password,
-            method='pbkdf2:sha256',
-            salt_length=8
-        )
+        # hashed in the password worker pool with the configured method and salt length
+        hash_and_salted_password = passwords.password_hasher.hash(password)
 
         base_user = BaseUser(
             email=email,
@@ -193,16 +376,27 @@ def login():
         if not user:
             flash("This email does not exist, please try again or register.")
             return redirect(url_for('register'))
+        matches, upgraded_hash = passwords.password_hasher.verify(user.password, password)
         # Password incorrect
-        elif not check_password_hash(user.password, password):
+        if not matches:
             flash('Password incorrect, please try again.')
             return redirect(url_for('login'))
         else:
+                # hashes made with older parameters are replaced while the plain password is at hand
+                if upgraded_hash:
+                    user.password = upgraded_hash
+                    db.session.commit()
                 login_user(user)
                 return redirect(url_for("home"))
     return render_template("login.html", form=form, current_user=current_user)
 
 
+# the password worker pool is saturated: shed the sign in instead of queueing it
+@app.errorhandler(passwords.HasherBusy)
+def password_hasher_busy(e):
+    return "Too many sign-ins right now, please try again in a moment.", 503, {"Retry-After": "1"}
+
+
 # logout 
 @app.route('/logout')
 def logout():
@@ -264,64 +458,179 @@ def address():
 @employee_required
 def employees():
     # Define SQLAlchemy model mappings for dynamic querying
-    model_mapping = {
-        "employees": Employee,
-        "departments": Department,
-        "products": Product,
-        "transactions": Transaction,
-        "clients": Client,
-        "inventory": Inventory,
-    }
-
-    # Default table to display when employee route selected
-    table_name = request.args.get("table", "transactions")
-    model = model_mapping.get(table_name)
-    query_data = db.session.execute(db.select(model)).scalars().all()
-    if query_data is None:
-            return f"Error: Table not found in employees", 400
+    model_mapping = admin.MODEL_MAPPING
 
-    # Handle dynamic table selection from POST requests providing access to other database information
+    # Default table to display when employee route selected. The side panel switches tables with POST requests
     if request.method == "POST":
-        table_name = request.form.get("table") 
-        model = model_mapping.get(table_name)
-        query_data = db.session.execute(db.select(model)).scalars().all()
-   
-    # Filter rows dynamically by ensuring only columns from the applicable table list are displayed
-    filtered_rows = []
-    for row in query_data:
-        row_dict = row.__dict__.copy()
-        row_dict.pop("_sa_instance_state", None)  # Remove SQLAlchemy metadata
-        filtered_row = {key: value for key, value in row_dict.items() if key != 'password'}
-        filtered_rows.append(filtered_row) # selects table's rows information
-    # select column headers
-    columns = list(filtered_rows[0].keys()) if filtered_rows else []
-    # find primary key
-    primary_key = get_primary_key(model)
+        table_name = request.form.get("table")
+    else:
+        table_name = request.args.get("table", "transactions")
+    model = model_mapping.get(table_name)
+    if model is None:
+        return f"Error: Table not found in employees", 400
+
+    # read one keyset page of column tuples, only visible columns (no passwords) and no ORM instances
+    sort = request.args.get("sort")
+    order = request.args.get("order", "asc")
+    filter_column = request.args.get("filter")
+    filter_value = request.args.get("q", "").strip()
+    try:
+        page = admin.browse_table(
+            model,
+            after=request.args.get("after", type=int),
+            after_value=request.args.get("after_value"),
+            sort=sort,
+            descending=order == "desc",
+            filter_column=filter_column,
+            filter_value=filter_value,
+        )
+    except ValueError as e:
+        flash(str(e), "danger")
+        page = admin.browse_table(model, sort=sort, descending=order == "desc")
 
     return render_template(
         "employees.html",
         table_title=table_name.capitalize(),
         table_name=table_name,
-        columns=columns,
-        rows=filtered_rows,
-        primary_key=primary_key,
+        columns=page.columns,
+        rows=page.rows,
+        primary_key=page.primary_key,
+        next_after=page.next_after,
+        next_value=page.next_value,
+        sortable=page.sortable,
+        filterable=page.filterable,
+        sort=sort if sort in page.sortable else page.primary_key,
+        order=order,
+        filter_column=filter_column,
+        filter_value=filter_value,
+    )
+
+
+# lists the recent request profiles (admins only)
+@app.route("/employees/profiles")
+@login_required
+@employee_required
+def profiles():
+    if not is_admin():
+        return "Access Denied: Your clearance code does not allow viewing profiles", 403
+    return render_template("profiles.html", profiles=profiler.profiler.recent(), sample_rate=profiler.profiler.sample_rate)
+
+
+# downloads one profile in folded stack format, e.g. for flamegraph.pl or speedscope.app
+@app.route("/employees/profiles/<name>")
+@login_required
+@employee_required
+def download_profile(name):
+    if not is_admin():
+        return "Access Denied: Your clearance code does not allow viewing profiles", 403
+    return send_from_directory(profiler.profiler.directory, name, mimetype="text/plain", as_attachment=True)
+
+
+# applies one update, delete or void to many rows of a table in one transaction: POST JSON
+# {"keys": [primary keys], "action": "update" | "delete" | "void", "patch": {column: value}} and get a status per key
+@app.route("/employees/batch/<table_name>", methods=["POST"])
+@login_required
+@employee_required
+def batch_records(table_name):
+    if table_name not in admin.MODEL_MAPPING:
+        return {"error": f"table {table_name} not found"}, 404
+    # same rule as update_record: only admins change employees
+    required_clearance = admin.RESTRICTED_TABLES.get(table_name)
+    if required_clearance and current_user.employee.clearance_code != required_clearance:
+        return {"error": f"clearance code {required_clearance} required to change {table_name}"}, 403
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return {"error": "expected a JSON object"}, 400
+    try:
+        results = admin.batch_apply(table_name, body.get("keys"), body.get("action"), body.get("patch"))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except IntegrityError as e:
+        return {"error": f"rejected by the database, nothing was changed: {e.orig}"}, 409
+    return {"table": table_name, "action": body["action"], "results": results}
+
+
+# autocomplete for the client and product id fields of the admin forms: up to limit rows whose id or name starts with q
+@app.route("/employees/autocomplete/<source>")
+@login_required
+@employee_required
+def autocomplete(source):
+    lookup = lookups.LOOKUPS.get(source)
+    if lookup is None:
+        abort(404)
+    matches = lookup.suggest(request.args.get("q", "")[:100], request.args.get("limit", lookups.AUTOCOMPLETE_LIMIT, type=int))
+    return jsonify([{"id": record_id, "label": label} for record_id, label in matches])
+
+
+# this route streams a whole table as CSV or NDJSON, e.g. for the nightly accounting jobs
+@app.route("/employees/export/<table_name>")
+@login_required
+@employee_required
+def export_table(table_name):
+    if table_name not in admin.MODEL_MAPPING:
+        return "Error: Table not found in export_table", 400
+    required_clearance = admin.RESTRICTED_TABLES.get(table_name)
+    if required_clearance and current_user.employee.clearance_code != required_clearance:
+        return "Access Denied: Your clearance code does not allow this export", 403
+
+    export_format = request.args.get("format", "csv")
+    if export_format not in ("csv", "ndjson"):
+        return f"Error: Unknown export format {export_format}", 400
+
+    since = request.args.get("since")
+    if since:
+        if table_name not in admin.SINCE_COLUMNS:
+            return f"Error: Table {table_name} does not support incremental exports", 400
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return "Error: since must be an ISO date or datetime", 400
+    else:
+        since = None
+
+    columns = [c.name for c in admin.visible_columns(admin.MODEL_MAPPING[table_name])]
+    rows = admin.export_rows(table_name, since=since)
+    if export_format == "csv":
+        body, mimetype = admin.as_csv(rows, columns), "text/csv"
+    else:
+        body, mimetype = admin.as_ndjson(rows, columns), "application/x-ndjson"
+    # stream_with_context keeps the app context (and the db session) alive while the generator runs
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={table_name}.{export_format}"},
     )
 
 
+# this route bulk loads products and stock from an uploaded spreadsheet
+@app.route("/employees/import", methods=["POST"])
+@login_required
+@employee_required
+def import_spreadsheet():
+    upload = request.files.get("spreadsheet")
+    if not upload or not upload.filename.lower().endswith((".xlsx", ".csv")):
+        flash("Please select an .xlsx or .csv file.", "danger")
+        return redirect(url_for("employees", table="products"))
+    rejects_path = os.path.join(app.instance_path, f"import_rejects_{datetime.now():%Y%m%d%H%M%S}.csv")
+    try:
+        stats = importer.import_inventory((upload.filename, upload.stream), rejects_path=rejects_path)
+    except importer.MissingHeader as e:
+        flash(f"Nothing imported: {e}.", "danger")
+        return redirect(url_for("employees", table="products"))
+    flash(f"Imported {stats['imported']} products from {stats['rows']} rows in {stats['seconds']}s "
+          f"({stats['rows_per_sec']} rows/sec), {stats['rejected']} rejected.", "success")
+    if stats["rejects_path"]:
+        flash(f"Rejected rows were written to {stats['rejects_path']}", "warning")
+    return redirect(url_for("employees", table="products"))
+
+
 # this route allows adding records
 @app.route("/add_record/<table_name>", methods=["GET","POST"])
 @login_required
 @employee_required
 def add_record(table_name):
     # Define SQLAlchemy model mappings for dynamic querying
-    model_mapping = {
-        "employees": Employee,
-        "departments": Department,
-        "products": Product,
-        "transactions": Transaction,
-        "clients": Client,
-        "inventory": Inventory,
-    }
+    model_mapping = admin.MODEL_MAPPING
 
     # Fetch the appropriate table dynamically
     model = model_mapping.get(table_name)
@@ -402,14 +711,7 @@ def add_record(table_name):
 @employee_required
 def update_record(table, record_id):
     # Define SQLAlchemy model mappings
-    model_mapping = {
-        "employees": Employee,
-        "departments": Department,
-        "products": Product,
-        "transactions": Transaction,
-        "clients": Client,
-        "inventory": Inventory,
-    }
+    model_mapping = admin.MODEL_MAPPING
 
     # Fetch the appropriate table dynamically
     model = model_mapping.get(table)
@@ -481,8 +783,12 @@ def update_record(table, record_id):
 @app.route("/cart", methods=["GET", "POST"])
 @login_required
 def view_cart():
-    cart_id = db.session.execute(select(UserCart).filter_by(client_id=current_user.id)).scalar().cart_id
-    cart_items = db.session.execute(select(CartItem).filter_by(cart_id=cart_id)).scalars().all()
+    # carts are served from the in-memory cart service; only the first visit reads the database
+    cart = carts.cart_service.get(current_user.id)
+    if cart is None:
+        flash("Only clients have a shopping cart.", "warning")
+        return redirect(url_for("home"))
+    cart_items = cart.cart_items
     total = sum(item.quantity * item.price for item in cart_items)
     return render_template("cart.html", cart_items=cart_items, total=total)
 
@@ -490,117 +796,142 @@ def view_cart():
 @app.route("/remove_from_cart/<int:product_id>", methods=["GET", "POST"])
 @login_required
 def remove_from_cart(product_id):
-    cart_id = db.session.execute(select(UserCart).filter_by(client_id=current_user.id)).scalar().cart_id
-    item = db.session.execute(select(CartItem).where(CartItem.cart_id == cart_id).where(CartItem.product_id == product_id)).scalar_one_or_none()
-    db.session.delete(item)
-    db.session.commit()
+    cart = carts.cart_service.get(current_user.id)
+    if cart is not None:
+        carts.cart_service.remove(cart, product_id)
     return redirect(url_for('view_cart'))
 
 
 @app.route("/add_to_cart/<department>/<int:product_id>", methods=["GET", "POST"])
 @login_required
 def add_to_cart(department, product_id):
-    cart_id = db.session.execute(select(UserCart).filter_by(client_id=current_user.id)).scalar().cart_id
+    # products without a department are added from the search page and return home
+    back = url_for("department_page", department=department) if catalog.departments.get_by_name(department) else url_for("home")
     quantity = request.form.get("quantity", type=int)
-    if quantity == 0:
+    if not quantity or quantity < 0:
         flash("Invalid quantity selected.", "danger")
-        return redirect(url_for("department_page", department=department))
-    # Ensure the requested quantity does not exceed inventory
-    inventory = db.session.execute(select(Inventory).filter_by(product_id=product_id)).scalar()
-    if not inventory or inventory.quantity < quantity:
+        return redirect(back)
+    # Ensure the requested quantity does not exceed inventory, as seen by the catalog read model
+    # once it caught up with the stock sold or edited through the other workers
+    catalog.sync.poll(force=True)
+    product = catalog.in_stock.get(product_id)
+    if not product or product.quantity < quantity:
         flash("Insufficient stock available.", "danger")
-        return render_template(url_for("department_page", department=department))
-    
-    product = db.session.execute(select(Product).filter_by(product_id=product_id)).scalar()
-    price = product.price  
-    description = product.description
-    print(description, f'product_id = {product.product_id}')
-    product_in_cart = db.session.execute(select(CartItem).where(CartItem.cart_id == cart_id).where(CartItem.product_id == product.product_id)).scalar()
-    
-    # add quantity if item already in cart
-    if product_in_cart:
-        print(product_in_cart.product_id)
-        product_in_cart.quantity += quantity
-
-    if not product_in_cart:
-        new_cart_item = CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity, price=price)
-        db.session.add(new_cart_item)
+        return redirect(back)
 
-    db.session.commit()
-    flash(f"Item {description} added to cart!", "message")
-    return redirect(url_for("department_page", department=department))
+    cart = carts.cart_service.get(current_user.id)
+    if cart is None:
+        flash("Only clients have a shopping cart.", "warning")
+        return redirect(back)
+    # the change stays in memory and is written to cart_items by the next batched flush
+    carts.cart_service.add(cart, product_id, quantity, product.price, product.description)
+    flash(f"Item {product.description} added to cart!", "message")
+    return redirect(back)
 
 
 @app.route('/create-checkout-session', methods=['POST'])
 @login_required
 def create_checkout_session():
-    cart_id = db.session.execute(select(UserCart).filter_by(client_id=current_user.id)).scalar().cart_id
-    cart_items = db.session.execute(select(CartItem).filter_by(cart_id=cart_id)).scalars().all()
-
-    if not cart_items:
+    cart = carts.cart_service.get(current_user.id)
+    if cart is None or not cart.cart_items:
         flash("Your cart is empty!", "warning")
         return redirect(url_for("view_cart"))
-    
-    # create cart item list
-    line_items = []
-    for item in cart_items:
-        product = db.session.execute(select(Product).filter_by(product_id=item.product_id)).scalar()
-        stripe_price_code = product.stripe_price_code
-        checkout_product = {
-            'price': stripe_price_code,
+
+    # checkout must never start from unsaved cart lines
+    carts.cart_service.flush([cart])
+
+    # create cart item list, with all Stripe price codes and current stock read in one query
+    products = {row.product_id: row for row in db.session.execute(
+        select(Product.product_id, Product.stripe_price_code, Inventory.quantity)
+        .outerjoin(Inventory, Inventory.product_id == Product.product_id)
+        .where(Product.product_id.in_(cart.lines))
+    )}
+    # stock is only reserved by the payment webhook, so don't let anyone pay for units that are already gone
+    short = [item.description for item in cart.cart_items
+             if item.product_id not in products or (products[item.product_id].quantity or 0) < item.quantity]
+    if short:
+        flash(f"Not enough stock for {', '.join(short)}.", "danger")
+        return redirect(url_for("view_cart"))
+    line_items = [
+        {
+            'price': products[item.product_id].stripe_price_code,
             'quantity': item.quantity,
         }
-        line_items.append(checkout_product)
+        for item in cart.cart_items
+    ]
+
+    # the order itself is recorded by the payment webhook, so checkout only needs the Stripe session url
+    metadata = orders.order_metadata(cart)
+
+    # with checkout workers enabled the Stripe call runs off the request thread and the browser polls for the result
+    if payments.checkout_jobs.enabled:
+        job_id = payments.checkout_jobs.submit(current_user.id, start_checkout, line_items, metadata)
+        if job_id is None:
+            metrics.checkout_outcome("busy")
+            flash("Checkout is very busy right now, please try again in a moment.", "warning")
+            return redirect(url_for("view_cart"))
+        return redirect(url_for("checkout_status", job_id=job_id))
 
     try:
-        checkout_session = stripe.checkout.Session.create(
-            line_items=line_items,
-            mode='payment',
-            success_url = f"{YOUR_DOMAIN}/",
-            cancel_url = f"{YOUR_DOMAIN}/",
-        )
-        update_database(cart_id, cart_items)
+        checkout_url = start_checkout(line_items, metadata)
     except Exception as e:
         return str(e)
 
-    flash("Checkout successful!", "success")
-    return redirect(checkout_session.url, code=303)
+    return redirect(checkout_url, code=303)
 
 
-def update_database(cart_id, cart_items):
-    total_amount = sum(item.quantity * item.price for item in cart_items)
+@app.route('/checkout/<job_id>')
+@login_required
+def checkout_status(job_id):
+    try:
+        done, checkout_url = payments.checkout_jobs.result(current_user.id, job_id)
+    except KeyError:
+        abort(404)
+    except Exception as e:
+        return str(e)
+    if not done:
+        return render_template("checkout_pending.html")
+    return redirect(checkout_url, code=303)
 
-    # Create a new transaction
-    new_transaction = Transaction(
-        client_id=current_user.id,
-        transaction_type="sell",  # from the store point of view
-        total_amount=total_amount,
-        transaction_date=datetime.utcnow()
-    )
-    db.session.add(new_transaction)
-    db.session.flush()
-
-    # Move cart items to TransactionItem
-    for item in cart_items:
-        transaction_item = TransactionItem(
-            transaction_id=new_transaction.transaction_id,
-            product_id=item.product_id,
-            quantity=item.quantity,
-            price=item.price
+
+def start_checkout(line_items, metadata):
+    """ Creates the Stripe checkout session and returns its url. """
+    try:
+        checkout_session = payments.create_checkout_session(
+            line_items,
+            success_url=f"{YOUR_DOMAIN}/",
+            cancel_url=f"{YOUR_DOMAIN}/",
+            client_reference_id=metadata["cart_id"],
+            metadata=metadata,
         )
-        db.session.add(transaction_item)
-        db.session.flush()
+    except Exception:
+        metrics.checkout_outcome("failed")
+        raise
+    metrics.checkout_outcome("started")
+    return checkout_session.url
 
-        # Reduce inventory stock
-        inventory = db.session.get(Inventory, item.product_id)
-        inventory.quantity -= item.quantity
 
-    # Commit all changes
-    db.session.commit()
+# Stripe calls this route when a checkout session is paid; the order is recorded here, once per session
+@app.route('/stripe/webhook', methods=['POST'])
+@csrf.exempt
+def stripe_webhook():
+    try:
+        event = payments.parse_webhook(request.get_data(), request.headers.get("Stripe-Signature"))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if event["type"] not in payments.PAID_CHECKOUT_EVENTS:
+        return {"status": "ignored"}
+    checkout_session = event["data"]["object"]
+    if checkout_session.get("payment_status") != "paid":
+        return {"status": "awaiting payment"}
 
-    # Clear the cart after successful checkout
-    db.session.execute(db.delete(CartItem).where(CartItem.cart_id == cart_id))
-    db.session.commit()
+    cart_id, client_id, lines = orders.parse_order_metadata(checkout_session["metadata"])
+    status = orders.finalize_order(db.session, checkout_session["id"], cart_id, client_id, lines)
+    metrics.checkout_outcome(f"paid_{status}")
+    if status == "short":
+        app.logger.error(f"Paid checkout {checkout_session['id']} recorded voided: not enough stock, refund needed")
+    return {"status": status}
 
 
 # adds product purchase to inventory
@@ -649,6 +980,36 @@ def update_inventory(session, transaction):
             return redirect(url_for("view_cart"))
         
 
+# makes the image derivatives ahead of the first page views, e.g. after an import
+@app.cli.command("build-images")
+def build_images_command():
+    """ Resizes every product image and the home page banners into the derivative cache. """
+    filenames = set(db.session.scalars(select(Product.image_url).where(Product.image_url.is_not(None))))
+    filenames.update(os.path.join("rock_img", name) for name in os.listdir(os.path.join(app.static_folder, "rock_img")))
+    made, failed = image_pipeline.build(sorted(name for name in filenames if images.ImagePipeline.can_resize(name)))
+    print(f"{made} derivatives ready in {image_pipeline.cache_folder}")
+    if failed:
+        print(f"could not resize: {', '.join(failed)}")
+
+
+# bulk loads products, departments and stock from a spreadsheet
+@app.cli.command("import-inventory")
+@click.argument("path", default=os.path.join("static", "store_inventory.xlsx"))
+@click.option("--rejects", default="import_rejects.csv", help="CSV file receiving the rejected rows.")
+@click.option("--chunk-size", default=importer.CHUNK_SIZE, help="Rows per transaction.")
+def import_inventory_command(path, rejects, chunk_size):
+    """ Upserts Product, Department and Inventory rows from an .xlsx or .csv file; exits 1 when it has no header row. """
+    try:
+        stats = importer.import_inventory(path, rejects_path=rejects, chunk_size=chunk_size)
+    except importer.MissingHeader as e:
+        print(f"{path}: {e}")
+        raise SystemExit(1)
+    print(f"{stats['rows']} rows, {stats['imported']} products imported, {stats['rejected']} rejected "
+          f"in {stats['seconds']}s ({stats['rows_per_sec']} rows/sec)")
+    if stats["rejects_path"]:
+        print(f"rejected rows written to {stats['rejects_path']}")
+
+
 # Run Flask App
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,86 @@
+import os
+import re
+import time
+from collections import Counter
+from flask import g, has_request_context, request
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listens_for
+
+
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 10))  # same statement shape per request before warning
+
+
+def statement_shape(statement):
+    """ Normalizes a statement so calls differing only in literal values or IN list lengths compare equal. """
+    shape = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", statement)
+    shape = re.sub(r"'[^']*'|\b\d+\b", "?", shape)
+    return " ".join(shape.split())
+
+
+# SQL counters of the current request, kept on flask.g. Statements run outside a request
+# (the cart flusher, CLI commands) are not counted.
+class RequestQueries:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+        self.shapes = Counter()
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.slowest:
+            self.slowest = seconds
+            self.slowest_statement = statement
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """ Returns (shape, count) for statement shapes run more than threshold times, most frequent first. """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count > threshold]
+
+    def server_timing(self):
+        total = (time.perf_counter() - self.started) * 1000
+        return (f'db;dur={self.seconds * 1000:.1f};desc="{self.count} queries", '
+                f'db-slowest;dur={self.slowest * 1000:.1f}, app;dur={total:.1f}')
+
+
+@listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@listens_for(Engine, "after_cursor_execute")
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    if has_request_context() and "queries" in g:
+        g.queries.record(statement, time.perf_counter() - started)
+
+
+@listens_for(Engine, "handle_error")
+def _drop_timer(context):
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+
+def init_app(app):
+    """ Counts and times the SQL of every request, reports it in a Server-Timing header and,
+    in debug mode, logs a warning for statement shapes repeated more than N_PLUS_ONE_THRESHOLD times. """
+    @app.before_request
+    def start_counting_queries():
+        g.queries = RequestQueries()
+
+    @app.after_request
+    def report_queries(response):
+        queries = g.get("queries")
+        if queries is None:
+            return response
+        response.headers["Server-Timing"] = queries.server_timing()
+        if app.debug:
+            if queries.slowest_statement:
+                app.logger.debug(f"{request.path}: {queries.count} queries, slowest {queries.slowest * 1000:.1f}ms: "
+                                 f"{' '.join(queries.slowest_statement.split())[:300]}")
+            for shape, count in queries.repeated():
+                app.logger.warning(f"possible N+1: {request.method} {request.path} ran {count}x: {shape[:300]}")
+        return response
@@ -0,0 +1,134 @@
+""" Local stand-in for the Stripe API, used to load-test checkout offline.
+
+    python stripe_stub.py --port 12111 --latency 0.3
+
+then start the store with STRIPE_API_BASE=http://127.0.0.1:12111 and any STRIPE_SECRET_KEY.
+Opening a checkout url (/pay/<session id>) "pays" the session: the stub posts a signed
+checkout.session.completed event to --webhook-url and redirects to the success url.
+Only the endpoints the store calls are implemented. """
+import argparse
+import hashlib
+import hmac
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.parse import parse_qs
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    webhook_url = None
+    webhook_secret = ""
+    webhook_copies = 1  # > 1 replays every event to exercise the store's idempotency
+    sessions = {}
+    sessions_lock = Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            return self._reply(500, {"error": {"type": "api_error", "message": "stub failure"}})
+        if self.path == "/v1/checkout/sessions":
+            form = parse_qs(body)
+            session_id = f"cs_test_{uuid.uuid4().hex}"
+            checkout_session = {
+                "id": session_id,
+                "object": "checkout.session",
+                "mode": form.get("mode", ["payment"])[0],
+                "status": "open",
+                "payment_status": "unpaid",
+                "client_reference_id": form.get("client_reference_id", [None])[0],
+                "metadata": {key[len("metadata["):-1]: values[0] for key, values in form.items() if key.startswith("metadata[")},
+                "success_url": form.get("success_url", [""])[0],
+                "cancel_url": form.get("cancel_url", [""])[0],
+                "url": f"http://{self.headers.get('Host')}/pay/{session_id}",
+            }
+            with self.sessions_lock:
+                self.sessions[session_id] = checkout_session
+            return self._reply(200, checkout_session)
+        self._reply(404, {"error": {"type": "invalid_request_error", "message": f"Unrecognized request URL {self.path}"}})
+
+    def do_GET(self):
+        if not self.path.startswith("/pay/"):
+            return self._reply(404, {"error": {"type": "invalid_request_error", "message": "not found"}})
+        with self.sessions_lock:
+            checkout_session = self.sessions.pop(self.path[len("/pay/"):], None)
+        if checkout_session is None:
+            return self._reply(404, {"error": {"type": "invalid_request_error", "message": "unknown or already paid session"}})
+        checkout_session.update(status="complete", payment_status="paid")
+        if self.webhook_url:
+            event = {
+                "id": f"evt_{uuid.uuid4().hex}",
+                "object": "event",
+                "type": "checkout.session.completed",
+                "data": {"object": checkout_session},
+            }
+            for _ in range(self.webhook_copies):
+                self._send_webhook(event)
+        self.send_response(303)
+        self.send_header("Location", checkout_session["success_url"])
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_webhook(self, event):
+        payload = json.dumps(event).encode()
+        timestamp = int(time.time())
+        signature = hmac.new(self.webhook_secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+        request = Request(self.webhook_url, data=payload, headers={
+            "Content-Type": "application/json",
+            "Stripe-Signature": f"t={timestamp},v1={signature}",
+        })
+        # like Stripe, a failed delivery is only logged; the payer is still sent to the success url
+        try:
+            with urlopen(request, timeout=10) as response:
+                response.read()
+        except HTTPError as e:
+            print(f"webhook {event['id']} answered {e.code}: {e.read()[:200].decode(errors='replace')}")
+        except URLError as e:
+            print(f"webhook {event['id']} not delivered: {e.reason}")
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Request-Id", f"req_{uuid.uuid4().hex[:14]}")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.1, help="random +/- seconds on top of latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--webhook-url", default="http://127.0.0.1:5000/stripe/webhook", help="store endpoint receiving payment events")
+    parser.add_argument("--webhook-secret", default="whsec_stub", help="must match the store's STRIPE_WEBHOOK_SECRET")
+    parser.add_argument("--webhook-copies", type=int, default=1, help="deliver every event this many times")
+    args = parser.parse_args()
+    StripeStubHandler.latency = args.latency
+    StripeStubHandler.jitter = args.jitter
+    StripeStubHandler.error_rate = args.error_rate
+    StripeStubHandler.webhook_url = args.webhook_url
+    StripeStubHandler.webhook_secret = args.webhook_secret
+    StripeStubHandler.webhook_copies = args.webhook_copies
+    server = ThreadingHTTPServer((args.host, args.port), StripeStubHandler)
+    print(f"Stripe stub listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
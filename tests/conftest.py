@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+import pytest
+
+# server.py configures its database when imported, so the temporary one has to be in the environment first
+FOLDER = tempfile.mkdtemp(prefix="online_store_tests_")
+os.environ["DATABASE_PROFILE"] = "url"
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(FOLDER, 'retail.db')}"
+os.environ.setdefault("FLASK_KEY", "tests")
+os.environ["STRIPE_WORKERS"] = "0"
+
+PRODUCTS = 30  # every fifth one out of stock
+
+
+@pytest.fixture(scope="session")
+def app():
+    """ The store app on a temporary SQLite database holding two departments and PRODUCTS products. """
+    import server
+    from database import db, Department, Product, Inventory
+    with server.app.app_context():
+        db.session.add_all([Department(department_id=1, name="Guitars"), Department(department_id=2, name="Drums")])
+        for n in range(1, PRODUCTS + 1):
+            db.session.add(Product(
+                product_id=n, department_id=n % 2 + 1, description=f"Product {n}", brand=f"Brand {n % 3}",
+                website_url="", image_url="logo.png", price=10 + n, cost=5, product_family=f"Family {n % 4}",
+                stripe_product_code="", stripe_price_code="",
+                inventory=Inventory(quantity=0 if n % 5 == 0 else n, acquired_date=datetime.utcnow()),
+            ))
+        db.session.commit()
+    yield server.app
+    with server.app.app_context():
+        db.engine.dispose()
+    shutil.rmtree(FOLDER, ignore_errors=True)
+
+
+@pytest.fixture
+def app_context(app):
+    with app.app_context():
+        yield
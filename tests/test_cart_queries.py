@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+from flask import g
+from sqlalchemy import select
+import carts
+import catalog
+import payments
+from database import db, Inventory, BaseUser, Client, UserCart
+
+LINES = 20
+
+
+def test_cart_and_checkout_statements_do_not_grow_with_the_cart(app, app_context, monkeypatch):
+    """ N+1 regression: view_cart (cart loaded and cached) and create_checkout_session send as many SQL
+    statements for a LINES line cart as for a 1-line cart. Stripe is not called. """
+    import server
+    monkeypatch.setattr(payments, "create_checkout_session", lambda *args, **kwargs: SimpleNamespace(url=server.YOUR_DOMAIN))
+    monkeypatch.setattr(payments.checkout_jobs, "_executor", None)
+    monkeypatch.setattr(catalog, "CATALOG_SYNC_SECONDS", float("inf"))
+    monkeypatch.setitem(app.config, "WTF_CSRF_ENABLED", False)
+
+    product_ids = db.session.scalars(
+        select(Inventory.product_id).where(Inventory.quantity > 0).order_by(Inventory.product_id).limit(LINES)
+    ).all()
+    user = BaseUser(email="cart-queries@example.invalid", password="!")
+    client = Client(first_name="Cart", last_name="Queries", document_id="cart-queries", user=user)
+    db.session.add_all([user, client, UserCart(client=client)])
+    db.session.commit()
+    user_id = user.id
+
+    def count(browser, method, path):
+        with browser:
+            browser.open(path, method=method)
+            return g.queries.count
+
+    browser = app.test_client()
+    with browser.session_transaction() as browser_session:
+        browser_session["_user_id"] = str(user_id)
+        browser_session["_fresh"] = True
+    browser.get("/cart")  # loads the user into the user cache
+    counts = {}
+    for size in (1, len(product_ids)):
+        cart = carts.cart_service.get(user_id)
+        for product_id in list(cart.lines):
+            carts.cart_service.remove(cart, product_id)
+        for product in map(catalog.in_stock.get, product_ids[:size]):
+            carts.cart_service.add(cart, product.product_id, 1, product.price, product.description)
+        carts.cart_service.flush([cart])
+        carts.cart_service.forget(cart.cart_id)
+        counts[size] = {
+            "view_cart (load)": count(browser, "GET", "/cart"),
+            "view_cart (cached)": count(browser, "GET", "/cart"),
+            "create_checkout_session": count(browser, "POST", "/create-checkout-session"),
+        }
+
+    assert len(product_ids) == LINES
+    assert counts[LINES] == counts[1]
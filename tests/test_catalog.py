@@ -0,0 +1,19 @@
+from sqlalchemy import select, func
+import catalog
+from database import db, Inventory, CatalogChange
+
+
+def test_in_stock_read_model_matches_the_database(app_context):
+    assert catalog.in_stock.verify() == []
+
+
+def test_catalog_etag_comes_from_the_shared_change_log(app_context):
+    """ Every worker derives the ETag from catalog_changes, so it moves with a commit and names its sequence number. """
+    before = catalog.version.etag()
+    inventory = db.session.scalar(select(Inventory).order_by(Inventory.product_id).limit(1))
+    inventory.quantity += 1
+    db.session.commit()
+    after = catalog.version.etag()
+    assert after != before
+    assert after.split("-")[0] == str(db.session.scalar(select(func.max(CatalogChange.seq))))
+    assert catalog.version.etag() == after
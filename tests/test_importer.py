@@ -0,0 +1,14 @@
+import io
+import pytest
+import importer
+
+
+def test_partial_reimport_keeps_the_stored_values(app_context):
+    """ A sheet without the optional columns must not blank them; the probe imports are rolled back. """
+    assert importer.check_partial_reimport() == {}
+
+
+def test_sheet_without_a_description_header_is_refused(app_context):
+    sheet = "name,price\nGuitar,10\n"
+    with pytest.raises(importer.MissingHeader, match="description"):
+        importer.import_inventory(("products.csv", io.BytesIO(sheet.encode())))
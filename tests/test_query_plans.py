@@ -0,0 +1,7 @@
+from database import db
+import query_plans
+
+
+def test_hot_path_statements_do_not_scan_whole_tables(app_context):
+    """ Run after schema or query changes: the catalog, login, cart, checkout and inventory statements use indexes. """
+    assert [(label, detail) for label, sql, detail in query_plans.full_scans(db.session)] == []
@@ -0,0 +1,81 @@
+import os
+import time
+from collections import namedtuple
+from threading import Lock
+from flask_login import UserMixin
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from database import db, BaseUser, Client, Employee
+from cache import changes
+
+
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 60))  # seconds a resolved identity is reused
+USER_CACHE_SIZE = 10000
+
+ClientProfile = namedtuple("ClientProfile", ["client_id", "first_name", "last_name"])
+EmployeeProfile = namedtuple("EmployeeProfile", ["employee_id", "first_name", "last_name", "job_title", "clearance_code"])
+
+
+# Plain, session independent copy of a logged in user with its client or employee profile.
+# It carries what the templates and decorators read from current_user, so it can be shared across requests.
+class CachedUser(UserMixin):
+    def __init__(self, user):
+        self.id = user.id
+        self.email = user.email
+        self.client = ClientProfile(user.client.client_id, user.client.first_name, user.client.last_name) if user.client else None
+        self.employee = EmployeeProfile(
+            user.employee.employee_id, user.employee.first_name, user.employee.last_name,
+            user.employee.job_title, user.employee.clearance_code,
+        ) if user.employee else None
+
+
+class UserCache:
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._users = {}  # user_id -> (expires_at, CachedUser)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """ Returns the CachedUser for user_id, loading the user and both profiles in one query on a miss. """
+        entry = self._users.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        user = db.session.execute(
+            select(BaseUser).where(BaseUser.id == user_id)
+            .options(joinedload(BaseUser.client), joinedload(BaseUser.employee))
+        ).unique().scalar_one_or_none()
+        if user is None:
+            return None
+        cached = CachedUser(user)
+        with self._lock:
+            if len(self._users) >= self.max_size:
+                self._drop_expired()
+            self._users[user_id] = (time.monotonic() + self.ttl, cached)
+        return cached
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        for user_id, (expires_at, cached) in list(self._users.items()):
+            if expires_at <= now:
+                del self._users[user_id]
+        if len(self._users) >= self.max_size:
+            self._users.clear()
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._users.pop(user_id, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache()
+# clearance codes and profiles edited through update_record (or anywhere else) take effect on the next request
+changes.subscribe([BaseUser], user_cache.invalidate, key=lambda obj: obj.id)
+changes.subscribe([Client, Employee], user_cache.invalidate, key=lambda obj: obj.user_id)